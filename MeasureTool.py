@@ -21,14 +21,971 @@
 # SOFTWARE.
 
 
+import os
+import json
+import time
+import queue
+import socket
+import asyncio
+import argparse
+import threading
+import warnings
+import concurrent.futures
 import tkinter as tk
 import tkinter.colorchooser
-from math import sqrt, atan2, degrees, acos
-from itertools import combinations
+import tkinter.filedialog
+from math import sqrt, atan2, degrees, radians, acos, hypot, ceil, cos, sin, isfinite
+from itertools import combinations, count
+from collections import Counter
+from fractions import Fraction
+from xml.sax.saxutils import escape
 import tkinter.ttk as ttk
 
+try:
+    from PIL import Image, ImageDraw, ImageFont, ImageTk
+except ImportError:  # Pillow is optional, only raster mode needs it
+    Image = ImageDraw = ImageFont = ImageTk = None
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, only group transforms need it
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # Windows locks the journal with msvcrt instead
+    fcntl = None
+    import msvcrt
+
+
+def ratio_label_position(x1, y1, x2, y2):
+    """Return where the ratio label of a line goes, beside the line depending on its orientation."""
+    midpoint_x = (x1 + x2) / 2
+    midpoint_y = (y1 + y2) / 2
+    angle = degrees(atan2(y2 - y1, x2 - x1))
+    if -45 <= angle <= 45:
+        # Horizontal-ish line
+        return midpoint_x, midpoint_y - 20
+    elif 45 < angle < 135:
+        # Vertical-ish line (positive slope)
+        return midpoint_x - 20, midpoint_y
+    elif -135 < angle < -45:
+        # Vertical-ish line (negative slope)
+        return midpoint_x + 20, midpoint_y
+    else:
+        # Horizontal-ish line (but inverted)
+        return midpoint_x, midpoint_y + 20
+
+
+def shared_vertex(coords1, coords2):
+    """Return the end point two segments have in common, or None."""
+    x1, y1, x2, y2 = coords1
+    x3, y3, x4, y4 = coords2
+    if (x1, y1) == (x3, y3) or (x1, y1) == (x4, y4):
+        return (x1, y1)
+    if (x2, y2) == (x3, y3) or (x2, y2) == (x4, y4):
+        return (x2, y2)
+    return None
+
+
+def segment_measurements(coords):
+    """Return lengths, angles with the horizontal (0° to 90°) and ratio label positions of segments.
+
+    `coords` holds one (x1, y1, x2, y2) row per segment; with NumPy all rows are computed at once.
+    """
+    if np is None:
+        lengths = [hypot(x2 - x1, y2 - y1) for x1, y1, x2, y2 in coords]
+        angles = []
+        for x1, y1, x2, y2 in coords:
+            angle = abs(degrees(atan2(y2 - y1, x2 - x1)))
+            angles.append(angle if angle <= 90 else 180 - angle)
+        return lengths, angles, [ratio_label_position(*c) for c in coords]
+
+    x1, y1, x2, y2 = np.asarray(coords, dtype=float).reshape(-1, 4).T
+    lengths = np.hypot(x2 - x1, y2 - y1)
+    direction = np.degrees(np.arctan2(y2 - y1, x2 - x1))
+    angles = np.abs(direction)
+    angles = np.where(angles <= 90, angles, 180 - angles)
+    # Same placement as ratio_label_position
+    conditions = [(direction >= -45) & (direction <= 45), (direction > 45) & (direction < 135), (direction > -135) & (direction < -45)]
+    label_x = (x1 + x2) / 2 + np.select(conditions, [0, -20, 20], 0)
+    label_y = (y1 + y2) / 2 + np.select(conditions, [-20, 0, 0], 20)
+    return lengths.tolist(), angles.tolist(), np.column_stack((label_x, label_y)).tolist()
+
+
+def pair_measurements(coords1, coords2, vertices):
+    """Return the angles between pairs of segments meeting at `vertices` and where their purple labels go.
+
+    Row i of `coords1` and `coords2` holds the (x1, y1, x2, y2) of the two segments of pair i.
+    Needs NumPy; computes the same values as angle_between_two_lines and intersection_label_position.
+    """
+    first = np.asarray(coords1, dtype=float).reshape(-1, 4)
+    second = np.asarray(coords2, dtype=float).reshape(-1, 4)
+    vertex = np.asarray(vertices, dtype=float).reshape(-1, 2)
+    # The far end of each segment, seen from the shared vertex
+    far1 = np.where((first[:, :2] == vertex).all(axis=1, keepdims=True), first[:, 2:], first[:, :2])
+    far2 = np.where((second[:, :2] == vertex).all(axis=1, keepdims=True), second[:, 2:], second[:, :2])
+    u = far1 - vertex
+    v = far2 - vertex
+    cos_theta = (u * v).sum(axis=1) / (np.hypot(u[:, 0], u[:, 1]) * np.hypot(v[:, 0], v[:, 1]))
+    angles = np.degrees(np.arccos(np.clip(cos_theta, -1, 1)))
+    label_x = (vertex[:, 0] + (first[:, 0] + first[:, 2] + second[:, 0] + second[:, 2]) / 4) / 2
+    label_y = (vertex[:, 1] + (first[:, 1] + first[:, 3] + second[:, 1] + second[:, 3]) / 4) / 2 - 20
+    return angles.tolist(), np.column_stack((label_x, label_y)).tolist()
+
+
+def perspective_lines(coords, frame):
+    """Return homogeneous lines, midpoints and directions of (N, 4) segments for vanishing point estimation.
+
+    Points are first moved into `frame` (center_x, center_y, scale) so the numbers stay well
+    conditioned; lines (a, b, c) with a*x + b*y + c = 0 are scaled so (a, b) is a unit normal.
+    """
+    center_x, center_y, scale = frame
+    segments = np.asarray(coords, dtype=float).reshape(-1, 4)
+    start = (segments[:, :2] - (center_x, center_y)) / scale
+    end = (segments[:, 2:] - (center_x, center_y)) / scale
+    ones = np.ones((len(segments), 1))
+    lines = np.cross(np.hstack((start, ones)), np.hstack((end, ones)))
+    lines /= np.hypot(lines[:, 0], lines[:, 1])[:, None]
+    return lines, (start + end) / 2, end - start
+
+
+def vanishing_point_residuals(points, midpoints, directions):
+    """Return a (K, N) array of the sine of the angle by which each segment misses each of K homogeneous points.
+
+    A segment points at a vanishing point when the direction from its midpoint to the point is
+    parallel to it; points at infinity (w = 0) are plain directions and work the same way.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    towards = points[:, None, :2] - points[:, None, 2:] * midpoints[None, :, :]
+    cross = directions[None, :, 0] * towards[..., 1] - directions[None, :, 1] * towards[..., 0]
+    lengths = np.hypot(directions[:, 0], directions[:, 1])[None, :] * np.hypot(towards[..., 0], towards[..., 1])
+    # A point right on the midpoint is missed by no angle at all
+    return np.divide(np.abs(cross), lengths, out=np.zeros_like(cross), where=lengths > 0)
+
+
+def vanishing_point_inliers(points, midpoints, directions, tolerance):
+    """Return a (K, N) mask of which segments point at which of K homogeneous points within `tolerance` degrees."""
+    return vanishing_point_residuals(points, midpoints, directions) <= np.sin(np.radians(tolerance))
+
+
+def solve_vanishing_point(normal_matrix):
+    """Return the homogeneous point closest to all lines whose normal equations sum to `normal_matrix`.
+
+    `normal_matrix` is the 3x3 sum of l l^T over the lines, so adding a line is a rank-one
+    update; the least squares point is its eigenvector with the smallest eigenvalue.
+    """
+    point = np.linalg.eigh(normal_matrix)[1][:, 0]
+    return -point if point[2] < 0 else point
+
+
+def find_vanishing_points(lines, midpoints, directions, max_points=3, min_lines=3, tolerance=2.0, samples=256, seed=0):
+    """Group segments by vanishing point with sequential RANSAC; return [(normal_matrix, indices), ...].
+
+    Each round intersects `samples` random pairs of the remaining segments, scores all candidate
+    points against all segments in one vectorized pass, refines the best by least squares and
+    removes its segments before looking for the next point.
+    """
+    rng = np.random.default_rng(seed)
+    remaining = np.arange(len(lines))
+    groups = []
+    while len(groups) < max_points and len(remaining) >= min_lines:
+        pairs = rng.integers(len(remaining), size=(samples, 2))
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        candidates = np.cross(lines[remaining[pairs[:, 0]]], lines[remaining[pairs[:, 1]]])
+        norms = np.linalg.norm(candidates, axis=1)
+        candidates = candidates[norms > 1e-12] / norms[norms > 1e-12, None]
+        if not len(candidates):
+            break
+        inliers = vanishing_point_inliers(candidates, midpoints[remaining], directions[remaining], tolerance)
+        best = inliers[inliers.sum(axis=1).argmax()]
+        if best.sum() < min_lines:
+            break
+        members = remaining[best]
+        normal_matrix = lines[members].T @ lines[members]
+        # The refined point may take in or drop a few segments
+        refined = vanishing_point_inliers(solve_vanishing_point(normal_matrix), midpoints[remaining], directions[remaining], tolerance)[0]
+        if refined.sum() >= min_lines:
+            members = remaining[refined]
+            normal_matrix = lines[members].T @ lines[members]
+            best = refined
+        groups.append((normal_matrix, members))
+        remaining = remaining[~best]
+    return groups
+
+
+# Bins of the statistics panel: angles with the horizontal, and length ratios to the reference line
+ANGLE_BINS = tuple(range(0, 91, 10))
+RATIO_BINS = (0, 0.25, 0.5, 0.75, 1, 1.25, 1.5, 2, 3, 4, float('inf'))
+
+
+def scene_statistics(coords, reference_lengths, max_denominator=8, tolerance=0.01):
+    """Summarise (N, 4) segments in vectorized passes for the statistics panel.
+
+    `reference_lengths` holds the reference line length of each segment's layer, NaN where
+    the layer has none. Returns a dict with:
+        count           number of segments
+        angles          counts per ANGLE_BINS bin of the angle with the horizontal
+        ratios          counts per RATIO_BINS bin of length / reference length
+        quartiles       25th, 50th and 75th percentile of those ratios, or None
+        proportions     [(Fraction, count), ...] of ratios within `tolerance` of a simple
+                        fraction with denominator up to `max_denominator`, most common first
+        vertices        [(x, y, lines, angle sum), ...] for ends shared by several segments,
+                        busiest first; the sum adds up the angles between neighbouring
+                        segments around the end, leaving out the open side
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 4)
+    dx, dy = coords[:, 2] - coords[:, 0], coords[:, 3] - coords[:, 1]
+    lengths = np.hypot(dx, dy)
+    angles = np.degrees(np.arctan2(np.abs(dy), np.abs(dx)))
+    statistics = {'count': len(coords), 'angles': np.histogram(angles, bins=ANGLE_BINS)[0].tolist()}
+
+    ratios = lengths / np.asarray(reference_lengths, dtype=float)
+    ratios = ratios[np.isfinite(ratios)]
+    statistics['ratios'] = np.histogram(ratios, bins=RATIO_BINS)[0].tolist()
+    statistics['quartiles'] = np.percentile(ratios, (25, 50, 75)).tolist() if len(ratios) else None
+
+    # Snap every ratio to its nearest simple fraction in one searchsorted pass
+    fractions = sorted({Fraction(numerator, denominator) for denominator in range(1, max_denominator + 1)
+                        for numerator in range(1, max_denominator * denominator + 1)})
+    values = np.array([float(fraction) for fraction in fractions])
+    right = np.clip(np.searchsorted(values, ratios), 1, len(values) - 1)
+    nearest = np.where(np.abs(values[right] - ratios) < np.abs(values[right - 1] - ratios), right, right - 1)
+    nearest = nearest[np.abs(values[nearest] - ratios) <= tolerance * ratios]
+    counts = np.bincount(nearest, minlength=len(values))
+    statistics['proportions'] = [(fractions[index], int(counts[index])) for index in np.argsort(-counts, kind='stable') if counts[index]]
+
+    # Group both ends of every segment by position and sort each group by direction
+    ends = np.concatenate((coords[:, :2], coords[:, 2:]))
+    directions = np.degrees(np.arctan2(np.concatenate((dy, -dy)), np.concatenate((dx, -dx)))) % 360
+    # Positions as complex numbers sort much faster than rows
+    vertices, groups, sizes = np.unique(ends[:, 0] + 1j * ends[:, 1], return_inverse=True, return_counts=True)
+    groups = groups.reshape(-1)
+    shared = sizes[groups] > 1
+    groups, directions = groups[shared], directions[shared]
+    order = np.lexsort((directions, groups))
+    groups, directions = groups[order], directions[order]
+    if len(groups):
+        first = np.r_[True, groups[1:] != groups[:-1]]
+        last = np.r_[groups[1:] != groups[:-1], True]
+        starts = np.flatnonzero(first)
+        following = np.where(last, np.maximum.accumulate(np.where(first, np.arange(len(groups)), 0)), np.arange(1, len(groups) + 1) % len(groups))
+        gaps = (directions[following] - directions) % 360
+        sums = np.add.reduceat(gaps, starts) - np.maximum.reduceat(gaps, starts)
+        ids = groups[starts]
+        busiest = np.lexsort((-sums, -sizes[ids]))
+        positions, sizes, sums = vertices[ids[busiest]], sizes[ids[busiest]], sums[busiest]
+        statistics['vertices'] = list(zip(positions.real.tolist(), positions.imag.tolist(), sizes.tolist(), sums.tolist()))
+    else:
+        statistics['vertices'] = []
+    return statistics
+
+
+def group_transform_matrix(mode, pivot, start, current):
+    """Return the 2x3 affine matrix for dragging a group from `start` to `current`.
+
+    mode 'm' moves, 'g' scales uniformly about `pivot` and 'r' rotates about `pivot`.
+    """
+    (px, py), (sx, sy), (cx, cy) = pivot, start, current
+    if mode == 'm':
+        return np.array([[1.0, 0.0, cx - sx], [0.0, 1.0, cy - sy]])
+    if mode == 'g':
+        start_distance = hypot(sx - px, sy - py)
+        # Never collapse lines to points, angles and ratios need a length
+        factor = max(0.01, hypot(cx - px, cy - py) / start_distance) if start_distance else 1.0
+        linear = np.eye(2) * factor
+    else:
+        theta = atan2(cy - py, cx - px) - atan2(sy - py, sx - px)
+        linear = np.array([[cos(theta), -sin(theta)], [sin(theta), cos(theta)]])
+    # x' = A (x - pivot) + pivot
+    offset = np.array(pivot) - linear @ np.array(pivot)
+    return np.column_stack((linear, offset))
+
+
+def transform_segments(coords, matrix):
+    """Apply a 2x3 affine matrix to an (N, 4) array of segments in one operation."""
+    points = coords.reshape(-1, 2)
+    return (points @ matrix[:, :2].T + matrix[:, 2]).reshape(-1, 4)
+
+
+def point_segment_distance(px, py, x1, y1, x2, y2):
+    """Calculate shortest distance between a point and a line segment."""
+    line_len = sqrt((x2 - x1)**2 + (y2 - y1)**2)
+    if line_len == 0:
+        return sqrt((x1 - px)**2 + (y1 - py)**2)
+    t = ((px - x1) * (x2 - x1) + (py - y1) * (y2 - y1)) / line_len**2
+    t = max(0, min(1, t))
+    proj_x = x1 + t * (x2 - x1)
+    proj_y = y1 + t * (y2 - y1)
+    return sqrt((proj_x - px)**2 + (proj_y - py)**2)
+
+
+def segment_intersects_box(x1, y1, x2, y2, min_x, min_y, max_x, max_y):
+    """Return True if the segment touches the axis-aligned box (Liang-Barsky clipping)."""
+    dx = x2 - x1
+    dy = y2 - y1
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x1 - min_x), (dx, max_x - x1), (-dy, y1 - min_y), (dy, max_y - y1)):
+        if p == 0:
+            # Parallel to this edge, so it must lie on the inner side
+            if q < 0:
+                return False
+            continue
+        t = q / p
+        if p < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+        if t0 > t1:
+            return False
+    return True
+
+
+def stroke_label_text(arc_length, chord_length, reference_length):
+    """Label of a freehand stroke: arc length relative to the reference, then chord-to-curve ratio."""
+    rows = []
+    if reference_length:
+        rows.append(f"{arc_length / reference_length:.2f}")
+    if arc_length:
+        rows.append(f"chord/arc {chord_length / arc_length:.2f}")
+    return "\n".join(rows)
+
+
+def intersection_label_position(common_vertex, coords1, coords2):
+    """Return where the purple angle label of two connected lines goes."""
+    x1, y1, x2, y2 = coords1
+    x3, y3, x4, y4 = coords2
+    offset_x = (common_vertex[0] + (x1 + x2 + x3 + x4) / 4) / 2
+    offset_y = (common_vertex[1] + (y1 + y2 + y3 + y4) / 4) / 2 - 20
+    return offset_x, offset_y
+
+
+def label_font(size):
+    """Return a Pillow font of roughly `size` pixels, falling back to the built-in bitmap font."""
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1 has no sized default font
+        try:
+            return ImageFont.truetype("DejaVuSans.ttf", size)
+        except OSError:
+            return ImageFont.load_default()
+
+
+def dash_segments(x1, y1, x2, y2, dash):
+    """Split a segment into the drawn pieces of a (on, off) dash pattern, like the canvas' dash option."""
+    length = hypot(x2 - x1, y2 - y1)
+    if not length:
+        return []
+    on, off = dash
+    dx, dy = (x2 - x1) / length, (y2 - y1) / length
+    pieces = []
+    start = 0.0
+    while start < length:
+        end = min(start + on, length)
+        pieces.append((x1 + dx * start, y1 + dy * start, x1 + dx * end, y1 + dy * end))
+        start = end + off
+    return pieces
+
+
+def render_scene_image(scene, scale=1.0):
+    """Draw a scene from MeasurementTool.scene_snapshot() into a transparent Pillow image."""
+    width = max(1, round(scene['width'] * scale))
+    height = max(1, round(scene['height'] * scale))
+    image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+
+    for line in scene['lines']:
+        coords = [c * scale for c in line['coords']]
+        width = max(1, round(line['width'] * scale))
+        if line.get('dash'):
+            for piece in dash_segments(*coords, [d * scale for d in line['dash']]):
+                draw.line(piece, fill=line['color'], width=width)
+        else:
+            draw.line(coords, fill=line['color'], width=width)
+    for stroke in scene.get('strokes', []):
+        points = [c * scale for c in stroke['points']]
+        draw.line(points, fill=stroke['color'], width=max(1, round(stroke['width'] * scale)), joint='curve')
+
+    fonts = {}
+    # Labels repeat a lot (1.00, 90.0°, ...), so each distinct text is rendered once and pasted
+    stamps = {}
+    for label in scene['labels']:
+        size = max(1, round(label.get('font_size', scene['font_size']) * scale))
+        key = (label['text'], label['color'], size)
+        if key not in stamps:
+            font = fonts.get(size) or fonts.setdefault(size, label_font(size))
+            left, top, right, bottom = draw.textbbox((0, 0), label['text'], font=font)
+            stamp = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+            ImageDraw.Draw(stamp).text((-left, -top), label['text'], fill=label['color'], font=font)
+            stamps[key] = stamp
+        stamp = stamps[key]
+        x, y = label['position']
+        # Center the text on its position like the canvas' anchor="center"
+        image.paste(stamp, (round(x * scale - stamp.width / 2), round(y * scale - stamp.height / 2)), stamp)
+    return image
+
+
+SVG_LINE_HEIGHT = 1.2  # em between the rows of a multi-line label
+
+
+def scene_to_svg(scene, scale=1.0, background=None):
+    """Return a scene from MeasurementTool.scene_snapshot() as an SVG document."""
+    width = max(1, round(scene['width'] * scale))
+    height = max(1, round(scene['height'] * scale))
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">']
+    if background:
+        parts.append(f'<rect width="100%" height="100%" fill="{background}"/>')
+
+    parts.append('<g stroke-linecap="round">')
+    for line in scene['lines']:
+        x1, y1, x2, y2 = (c * scale for c in line['coords'])
+        parts.append(f'<line x1="{x1:.2f}" y1="{y1:.2f}" x2="{x2:.2f}" y2="{y2:.2f}" stroke="{line["color"]}" stroke-width="{line["width"] * scale:g}"/>')
+    for stroke in scene.get('strokes', []):
+        points = stroke['points']
+        path = " ".join(f"{points[i] * scale:.2f},{points[i + 1] * scale:.2f}" for i in range(0, len(points), 2))
+        parts.append(f'<polyline points="{path}" fill="none" stroke-linejoin="round" stroke="{stroke["color"]}" stroke-width="{stroke["width"] * scale:g}"/>')
+    parts.append('</g>')
+
+    parts.append(f'<g font-family="sans-serif" font-size="{scene["font_size"] * scale:g}" text-anchor="middle" dominant-baseline="central">')
+    for label in scene['labels']:
+        x, y = label['position']
+        # Labels without a size of their own use the group's
+        size = f' font-size="{label["font_size"] * scale:g}"' if 'font_size' in label else ''
+        rows = label['text'].split("\n")
+        if len(rows) == 1:
+            parts.append(f'<text x="{x * scale:.2f}" y="{y * scale:.2f}" fill="{label["color"]}"{size}>{escape(label["text"])}</text>')
+            continue
+        # SVG collapses newlines, so each row gets a tspan, with the block centered on the position like the canvas
+        first_dy = -(len(rows) - 1) * SVG_LINE_HEIGHT / 2
+        spans = "".join(f'<tspan x="{x * scale:.2f}" dy="{first_dy if index == 0 else SVG_LINE_HEIGHT:g}em">{escape(row)}</tspan>'
+                        for index, row in enumerate(rows))
+        parts.append(f'<text x="{x * scale:.2f}" y="{y * scale:.2f}" fill="{label["color"]}"{size}>{spans}</text>')
+    parts.append('</g>')
+    parts.append('</svg>')
+    return "\n".join(parts)
+
+
+def export_scene(scene, path, scale=1.0, background='white'):
+    """Write a scene to `path` as PNG, SVG or JSON, chosen by the file extension, and return the path.
+
+    `scene` is a MeasurementTool.scene_snapshot() dict or the path of a scene saved as .json.
+    `scale` multiplies the resolution; `background` may be None for a transparent picture.
+    """
+    if isinstance(scene, str):
+        with open(scene, encoding='utf-8') as f:
+            scene = json.load(f)
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.png':
+        if Image is None:
+            raise RuntimeError("PNG export needs Pillow (pip install pillow)")
+        image = render_scene_image(scene, scale)
+        if background:
+            image = Image.alpha_composite(Image.new('RGBA', image.size, background), image)
+        image.save(path)
+    elif extension == '.svg':
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(scene_to_svg(scene, scale, background))
+    elif extension == '.json':
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(scene, f)
+    else:
+        raise ValueError(f"Unsupported export format {extension!r}, use .png, .svg or .json")
+    return path
+
+
+def _export_job(job):
+    return export_scene(*job)
+
+
+def export_scenes(jobs, max_workers=None):
+    """Export many scenes in parallel across a process pool, returning the written paths in order.
+
+    `jobs` is a list of argument tuples for export_scene: (scene, path, scale[, background]).
+    Pass saved scene paths rather than dicts to keep what is sent to the workers small.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(_export_job, jobs))
+
+
+class CanvasItemRegistry:
+    """Keep track of every canvas item the tool creates, grouped by category.
+
+    Categories used by MeasurementTool:
+        line          committed measurement lines
+        ratio         ratio labels of committed lines
+        angle         red horizontal-angle labels of committed lines
+        intersection  purple angle labels between connected lines
+        preview       the line and labels shown while dragging
+        highlight     yellow / green vertex highlights
+        crosshair     the dashed mouse axis lines
+        raster        the cached image of the scene in raster mode
+        stroke        freehand strokes and their labels
+        selection     the rubber band drawn while selecting lines
+        perspective   vanishing point markers and the horizon
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.items = {}  # canvas item id -> category
+
+    def create(self, category, kind, *args, **kwargs):
+        """Create a canvas item of `kind` ('line', 'text', 'oval', ...) and register it."""
+        item = getattr(self.canvas, 'create_' + kind)(*args, **kwargs)
+        self.items[item] = category
+        return item
+
+    def delete(self, item):
+        """Delete a registered item. None is ignored so callers can pass optional handles."""
+        if item is None:
+            return
+        self.canvas.delete(item)
+        self.items.pop(item, None)
+
+    def set_category(self, item, category):
+        """Move an item to another category, e.g. when a preview line is committed."""
+        self.items[item] = category
+
+    def counts(self):
+        """Return the number of live items per category."""
+        return Counter(self.items.values())
+
+    def untracked(self):
+        """Return canvas items that exist on the canvas but were not created through the registry."""
+        return set(self.canvas.find_all()) - set(self.items)
+
+    def budget(self, lines, strokes=()):
+        """Return the maximum number of items each category may hold for the given lines and strokes."""
+        vertex_degree = Counter()
+        for _, data in lines:
+            x1, y1, x2, y2 = data['coords']
+            vertex_degree[(x1, y1)] += 1
+            vertex_degree[(x2, y2)] += 1
+        # Every pair of lines sharing a vertex gets at most one purple label
+        shared_pairs = sum(k * (k - 1) // 2 for k in vertex_degree.values())
+        n = len(lines)
+        return {
+            'line': n,
+            'ratio': n,
+            'angle': n,
+            'intersection': shared_pairs,
+            # Preview line, ratio and angle labels plus one purple label per line at the start vertex
+            'preview': 3 + max(vertex_degree.values(), default=0),
+            'highlight': 2,
+            'crosshair': 2,
+            'raster': 1,
+            # A polyline and a label per stroke
+            'stroke': 2 * len(strokes),
+            'selection': 1,
+            # A marker and a label per vanishing point, plus the horizon and its label
+            'perspective': 2 * MeasurementTool.MAX_VANISHING_POINTS + 2,
+        }
+
+    def over_budget(self, lines, strokes=()):
+        """Return {category: (live, allowed)} for every category holding more items than allowed."""
+        budget = self.budget(lines, strokes)
+        return {category: (count, budget.get(category, 0))
+                for category, count in self.counts().items()
+                if count > budget.get(category, 0)}
+
+
+class SegmentIndex:
+    """R-tree of segment bounding boxes for picking lines and selecting them with a box.
+
+    The tree is bulk-loaded with Sort-Tile-Recursive packing, NODE_SIZE boxes per node, so
+    a query visits O(log N) nodes plus the ones holding results. Inserts wait in a small
+    unpacked buffer and removals only forget the key; the tree is repacked on the next
+    query once the buffer or the forgotten entries grow too big, so adding a batch of lines
+    costs one repack.
+    """
+
+    NODE_SIZE = 16
+    MAX_BUFFER = 64
+
+    def __init__(self):
+        self.boxes = {}  # key -> (min_x, min_y, max_x, max_y)
+        self.root = None  # (box, children) of the packed tree
+        self.height = 0  # levels below the root; leaf nodes hold (box, key) entries
+        self.packed = 0  # entries in the packed tree
+        self.buffer = set()  # keys inserted or moved since the tree was packed
+        self.stale = 0  # packed entries removed or moved since
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def insert(self, key, coords):
+        """Index the segment `key` with end points (x1, y1, x2, y2), replacing its old position."""
+        x1, y1, x2, y2 = coords
+        if key in self.boxes and key not in self.buffer:
+            self.stale += 1
+        self.boxes[key] = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        self.buffer.add(key)
+
+    def remove(self, key):
+        if self.boxes.pop(key, None) is None:
+            return
+        if key in self.buffer:
+            self.buffer.discard(key)
+        else:
+            self.stale += 1
+
+    def clear(self):
+        self.__init__()
+
+    def pack(self):
+        """Rebuild the tree from every indexed box."""
+        nodes = [(box, key) for key, box in self.boxes.items()]
+        self.packed = len(nodes)
+        self.buffer = set()
+        self.stale = 0
+        self.root = None
+        self.height = -1
+        while nodes:
+            nodes = self._pack_level(nodes)
+            self.height += 1
+            if len(nodes) == 1:
+                self.root = nodes[0]
+                break
+
+    def _pack_level(self, items):
+        """Group (box, child) items into nodes: slabs sorted by x, then runs of NODE_SIZE sorted by y."""
+        size = self.NODE_SIZE
+        slab_size = size * ceil(sqrt(ceil(len(items) / size)))
+        items.sort(key=lambda item: item[0][0] + item[0][2])
+        nodes = []
+        for start in range(0, len(items), slab_size):
+            slab = sorted(items[start:start + slab_size], key=lambda item: item[0][1] + item[0][3])
+            for i in range(0, len(slab), size):
+                children = slab[i:i + size]
+                box = (min(child[0][0] for child in children), min(child[0][1] for child in children),
+                       max(child[0][2] for child in children), max(child[0][3] for child in children))
+                nodes.append((box, children))
+        return nodes
+
+    def query(self, min_x, min_y, max_x, max_y):
+        """Return the set of keys whose bounding box overlaps the given box."""
+        if len(self.buffer) > self.MAX_BUFFER or self.stale > max(self.MAX_BUFFER, self.packed // 4):
+            self.pack()
+
+        found = set()
+        stack = [(self.root, self.height)] if self.root else []
+        while stack:
+            (_, children), level = stack.pop()
+            for child in children:
+                box = child[0]
+                if box[0] <= max_x and box[2] >= min_x and box[1] <= max_y and box[3] >= min_y:
+                    if level:
+                        stack.append((child, level - 1))
+                    # Entries of removed or moved keys no longer match the key's box
+                    elif self.boxes.get(child[1]) == box:
+                        found.add(child[1])
+        for key in self.buffer:
+            box = self.boxes[key]
+            if box[0] <= max_x and box[2] >= min_x and box[1] <= max_y and box[3] >= min_y:
+                found.add(key)
+        return found
+
+
+class StrokeSimplifier:
+    """Simplify a freehand pointer path while it streams in.
+
+    Points closer than `min_distance` to the previous accepted point are dropped (radial
+    distance filter). Accepted points wait in `pending` until the path since the last kept
+    point no longer fits one straight chord within `tolerance` pixels; then the last point
+    that still fit is kept (a streaming Douglas-Peucker). `max_pending` bounds the work per
+    point, so long, high-rate strokes stay cheap. The arc length is summed over accepted
+    points, which also keeps pixel jitter out of the measurement.
+    """
+
+    def __init__(self, x, y, tolerance=1.5, min_distance=3.0, max_pending=50):
+        self.tolerance = tolerance
+        self.min_distance = min_distance
+        self.max_pending = max_pending
+        self.points = [(x, y)]  # kept points
+        self.pending = []  # accepted points since the last kept one
+        self.current = (x, y)
+        self.accepted_length = 0.0
+
+    def last_accepted(self):
+        return self.pending[-1] if self.pending else self.points[-1]
+
+    def add(self, x, y):
+        """Feed the next pointer position."""
+        self.current = (x, y)
+        last_x, last_y = self.last_accepted()
+        step = hypot(x - last_x, y - last_y)
+        if step < self.min_distance:
+            return
+        self.accepted_length += step
+
+        if len(self.pending) >= self.max_pending or not self.chord_fits(x, y):
+            # The pending points fitted the chord to the newest of them, so keeping that one is enough
+            self.points.append(self.pending[-1])
+            self.pending = []
+        self.pending.append((x, y))
+
+    def chord_fits(self, x, y):
+        """Return True if every pending point lies within tolerance of the chord from the last kept point to (x, y)."""
+        anchor_x, anchor_y = self.points[-1]
+        return all(point_segment_distance(px, py, anchor_x, anchor_y, x, y) <= self.tolerance for px, py in self.pending)
+
+    def length(self):
+        """Arc length of the stroke up to the current position."""
+        last_x, last_y = self.last_accepted()
+        return self.accepted_length + hypot(self.current[0] - last_x, self.current[1] - last_y)
+
+    def chord_length(self):
+        """Straight distance from the first point to the current position."""
+        (x1, y1), (x2, y2) = self.points[0], self.current
+        return hypot(x2 - x1, y2 - y1)
+
+    def preview_points(self):
+        """Kept points and the current position, flattened for Canvas.coords."""
+        return [c for point in self.points + [self.current] for c in point]
+
+    def finish(self):
+        """End the stroke at the current position and return the simplified points."""
+        # The current position becomes a kept point, so count the step to it that the radial filter skipped
+        self.accepted_length = self.length()
+        x, y = self.current
+        pending = [point for point in self.pending if point != self.current]
+        if pending and not self.chord_fits(x, y):
+            self.points.append(pending[-1])
+        if self.points[-1] != self.current:
+            self.points.append(self.current)
+        self.pending = []
+        return self.points
+
+
+class Layer:
+    """A named group of lines with its own reference line and style.
+
+    Every canvas item that belongs to the layer carries `tag`, so the whole layer can be
+    shown or hidden with a single itemconfigure call.
+    """
+
+    def __init__(self, name, tag, color='black', width=2):
+        self.name = name
+        self.tag = tag
+        self.color = color
+        self.width = width
+        self.visible = True
+        self.stale = False  # set when labels were not refreshed because the layer was hidden
+        self.lines = set()
+        self.reference_line = None
+        self.reference_line_length = None
+
+
+class SceneColumns:
+    """Columnar copy of the committed lines for the statistics panel: one row per line in numpy arrays.
+
+    The tool updates rows edit by edit as it indexes lines, so statistics are vectorized
+    passes over these arrays instead of walks over self.lines or the canvas. A removed row
+    is filled with the last one and the arrays double when full.
+    """
+
+    def __init__(self, capacity=64):
+        self.rows = {}  # key -> row
+        self.keys = []  # row -> key
+        self.coords = np.zeros((capacity, 4))
+        self.layers = np.zeros(capacity, dtype=int)  # row -> number of the layer in layer_list
+        self.layer_list = []
+        self.layer_numbers = {}  # layer -> number
+
+    def __len__(self):
+        return len(self.keys)
+
+    def set(self, key, coords, layer):
+        """Add the row of `key`, or overwrite it if it is already there."""
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = len(self.keys)
+            self.keys.append(key)
+            if row == len(self.coords):
+                self.coords = np.concatenate((self.coords, np.zeros_like(self.coords)))
+                self.layers = np.concatenate((self.layers, np.zeros_like(self.layers)))
+        if layer not in self.layer_numbers:
+            self.layer_numbers[layer] = len(self.layer_list)
+            self.layer_list.append(layer)
+        self.coords[row] = coords
+        self.layers[row] = self.layer_numbers[layer]
+
+    def remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+        last = len(self.keys) - 1
+        if row != last:
+            moved = self.keys[last]
+            self.keys[row] = moved
+            self.rows[moved] = row
+            self.coords[row] = self.coords[last]
+            self.layers[row] = self.layers[last]
+        self.keys.pop()
+
+    def clear(self):
+        self.rows.clear()
+        self.keys.clear()
+
+    def statistics(self):
+        """Return scene_statistics of the rows on visible layers, with each layer's reference length."""
+        count = len(self.keys)
+        visible = np.array([layer.visible for layer in self.layer_list], dtype=bool)
+        references = np.array([layer.reference_line_length or np.nan for layer in self.layer_list], dtype=float)
+        layers = self.layers[:count]
+        shown = visible[layers] if count else np.zeros(0, dtype=bool)
+        return scene_statistics(self.coords[:count][shown], references[layers][shown] if count else [])
+
+
+class JournalLockedError(RuntimeError):
+    """Raised when another MeasureTool is already journaling to the same directory."""
+
+
+class OperationJournal:
+    """Append-only log of scene edits in `directory`, for restoring the scene after a crash or restart.
+
+    Every edit is appended to journal.jsonl as one JSON object with a growing sequence
+    number. Writes go through the OS buffer and sync() fsyncs them in one go, so the tool
+    calls it at most every FSYNC_INTERVAL ms instead of once per edit. Once COMPACT_EVERY
+    entries have piled up the whole scene is written to snapshot.json (through a temporary
+    file, so a crash never leaves half a snapshot) and the journal starts over; loading only
+    replays the short tail. Entries already covered by the snapshot are recognised by their
+    sequence number, which keeps a crash between the two steps harmless.
+
+    load() takes an exclusive lock on the directory until close(), so two overlays never
+    interleave their entries or overwrite each other's snapshot.
+    """
+
+    FSYNC_INTERVAL = 200  # ms
+    COMPACT_EVERY = 1000  # entries
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.journal_path = os.path.join(directory, 'journal.jsonl')
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.lock_path = os.path.join(directory, 'lock')
+        self.lock_file = None
+        self.seq = 0  # sequence number of the last entry
+        self.entries_since_snapshot = 0
+        self.dirty = False  # entries written but not yet fsynced
+        self.file = None
+
+    def load(self):
+        """Return the snapshot (or None) and the journal entries written after it.
+
+        Raises JournalLockedError if another process holds the directory.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock()
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self.seq = snapshot['seq']
+        entries = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding='utf-8') as f:
+                for row in f:
+                    try:
+                        entry = json.loads(row)
+                    except ValueError:
+                        # The last write was cut off by the crash
+                        break
+                    if entry['seq'] > self.seq:
+                        entries.append(entry)
+                        self.seq = entry['seq']
+        return snapshot, entries
+
+    def lock(self):
+        self.lock_file = open(self.lock_path, 'a+')
+        try:
+            if fcntl:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.lock_file.seek(0)
+                msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise JournalLockedError(f"{self.directory} is in use by another MeasureTool") from None
+
+    def append(self, op, **fields):
+        self.seq += 1
+        self.file.write(json.dumps(dict(fields, op=op, seq=self.seq)) + "\n")
+        self.dirty = True
+        self.entries_since_snapshot += 1
+
+    def sync(self):
+        """Make the entries appended so far durable."""
+        if self.dirty:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def needs_compaction(self):
+        return self.entries_since_snapshot >= self.COMPACT_EVERY
+
+    def write_snapshot(self, state):
+        """Replace the snapshot with `state`, a MeasurementTool.scene_state() dict, and empty the journal."""
+        temporary_path = self.snapshot_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(state, seq=self.seq), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+        if self.file:
+            self.file.close()
+        self.file = open(self.journal_path, 'w', encoding='utf-8')
+        self.entries_since_snapshot = 0
+        self.dirty = False
+
+    def set_aside(self):
+        """Move the snapshot and journal into a broken-<time> folder of the directory and return its path."""
+        aside = os.path.join(self.directory, time.strftime('broken-%Y%m%d-%H%M%S'))
+        os.makedirs(aside, exist_ok=True)
+        for path in (self.snapshot_path, self.journal_path):
+            if os.path.exists(path):
+                os.replace(path, os.path.join(aside, os.path.basename(path)))
+        self.seq = 0
+        self.entries_since_snapshot = 0
+        return aside
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+        if self.lock_file:
+            # Closing the file releases the lock
+            self.lock_file.close()
+            self.lock_file = None
+
+
 class MeasurementTool:
-    
+
+    # Set MEASURETOOL_CHECK_ITEMS=1 to check the canvas item budget after every edit
+    CHECK_ITEMS = os.environ.get('MEASURETOOL_CHECK_ITEMS', '') not in ('', '0')
+
+    # Line colors given to new layers in turn
+    LAYER_COLORS = ['black', 'darkgreen', 'darkorange', 'saddlebrown', 'deeppink']
+
+    # Tag carried by committed lines and their labels, i.e. everything raster mode bakes into one image
+    SCENE_TAG = 'scene'
+
+    # Resolution multiplier for pictures exported with 'e'
+    EXPORT_SCALE = 2
+
+    # Keys held while dragging to move, rotate or scale ("grow") the selected lines
+    TRANSFORM_MODES = ('m', 'r', 'g')
+    SELECTION_DASH = (6, 3)  # how selected lines are drawn
+    LABEL_FONT_SIZE = 12  # labels without a size of their own, such as stroke lengths
+
+    # Perspective mode: how far (in degrees) a line may miss its vanishing point, and how many points to look for
+    PERSPECTIVE_TOLERANCE = 2.0
+    MAX_VANISHING_POINTS = 3
+    # Search all lines again once this share of them came in incrementally, or that much more of the new lines fit no point than expected
+    PERSPECTIVE_REFIT = 0.25
+
     def __init__(self, root):
         self.root = root
 
@@ -46,19 +1003,55 @@ class MeasurementTool:
         self.canvas = tk.Canvas(self.overlay, bg='grey', bd=0, highlightthickness=0)
         self.canvas.pack(fill=tk.BOTH, expand=True)
 
+        # Every item drawn on the canvas goes through this registry so leaks can be detected
+        self.canvas_items = CanvasItemRegistry(self.canvas)
+
+        # Named layers, each with its own reference line and style
+        self.layers = {}
+        self.active_layer = self.add_layer()
+
+        # Font size and color of each kind of label, changed in the settings
+        self.label_styles = {kind: {'font_size': self.LABEL_FONT_SIZE, 'color': color}
+                             for kind, color in (('angle', 'red'), ('ratio', 'black'), ('intersection', 'purple'))}
+
+        # Raster mode draws committed lines and labels as one cached image
+        self.raster_mode = False
+        self.raster_item = None
+        self.raster_photo = None
+        self.raster_version = None
+        self.raster_pending = False
+        self.scene_version = 0
+
+        # Perspective mode estimates vanishing points of the lines, see update_perspective
+        self.perspective = None
+        self.perspective_pending = False
+        self.perspective_items = []
+
+        # The statistics panel keeps a columnar copy of the lines while it is open
+        self.statistics_window = None
+        self.scene_columns = None
+        self.statistics_pending = False
+
+        # Lines and strokes get uids that, unlike canvas ids, survive a restart
+        self.next_uid = 1
+        self.journal = None
+        self.journal_sync_pending = False
+
         # Initialization of attributes
         self.initialize_attributes()
 
         self.show_shortcuts()
+        self.show_layer_status()
 
         # Bindings
         self.overlay.bind("d", self.prepare_drawing)
         self.overlay.bind("<KeyRelease-d>", self.stop_drawing)
         self.overlay.bind("f", self.start_free_drawing)
         self.overlay.bind("<KeyRelease-f>", self.stop_drawing)
+        self.overlay.bind("c", self.start_stroke_drawing)
+        self.overlay.bind("<KeyRelease-c>", self.stop_drawing)
         self.overlay.bind("<Escape>", self.exit_program)
         self.overlay.bind("<Control-w>", self.exit_program)
-        self.undo_stack = []
         self.overlay.bind("<Control-z>", self.undo_last_action)  # Bind undo to Ctrl+Z
         self.overlay.bind("<Control-r>", self.clear_screen)  # Bind clear screen to Ctrl+R
         # self.overlay.bind("s", self.toggle_snapping_on)
@@ -69,6 +1062,21 @@ class MeasurementTool:
         self.overlay.bind("<KeyRelease-Shift_L>", self.shift_released)      
         self.settings_window = None
         self.overlay.bind("i", self.open_settings)
+        self.overlay.bind("n", self.new_layer)
+        self.overlay.bind("l", self.cycle_active_layer)
+        self.overlay.bind("h", self.toggle_active_layer)
+        for number in range(1, 10):
+            self.overlay.bind(str(number), self.toggle_layer_by_number)
+        self.overlay.bind("b", self.toggle_raster_mode)
+        self.overlay.bind("e", self.export)
+        self.overlay.bind("v", self.toggle_perspective_mode)
+        self.overlay.bind("a", self.toggle_statistics)
+        self.overlay.bind("<Delete>", self.delete_selected_lines)
+        for key in self.TRANSFORM_MODES:
+            self.overlay.bind(key, self.start_group_transform)
+            self.overlay.bind(f"<KeyRelease-{key}>", self.stop_drawing)
+        self.overlay.bind("<BackSpace>", self.delete_selected_lines)
+        self.server = None
 
 
 
@@ -78,26 +1086,52 @@ class MeasurementTool:
         self.end_x = None
         self.end_y = None
         self.current_line = None
-        self.reference_line = None
         self.lines = []
+        self.line_data = {}  # line -> data, for lookups without scanning self.lines
+        self.segment_index = SegmentIndex()  # line -> bounding box, for picking and box selection
+        self.vertex_lines = {}  # (x, y) -> lines ending there, for updating only what a change touches
+        self.intersection_texts = {}  # purple label -> its text, to skip unchanged updates
+        if self.scene_columns is not None:
+            self.scene_columns.clear()
+        self.transform = None  # state of the group transform being dragged
+        self.vertex_drag = None  # state of the vertex being dragged
+        self.live_lines = set()  # lines being dragged, drawn as vector items and left out of the raster
+        self.selected_lines = set()
+        self.selection_start = None  # corner where the rubber band started
+        self.strokes = {}  # stroke polyline -> data
+        self.line_uids = {}  # uid -> line
+        self.stroke_uids = {}  # uid -> stroke polyline
+        self.stroke = None  # StrokeSimplifier of the stroke being drawn
+        self.undo_stack = []  # ('line' or 'stroke', item), ('move', [(line, old coords), ...]) or ('remove', deleted lines), oldest first
         self.selected_vertex = None
         self.vertex_highlight = None
         self.selected_vertex_highlight = None
         self.drawing_mode = None
         self.line_drawn = False
-        self.reference_line_length = None
         self.ratio_display = None
         self.angle_display = None
         self.snapping_mode = False
         self.temp_intersection_angles = []
 
+        # Clearing keeps the layers but empties them
+        for layer in self.layers.values():
+            layer.lines.clear()
+            layer.reference_line = None
+            layer.reference_line_length = None
+            layer.stale = False
+
         self.canvas.bind("<Button-1>", self.on_click)
         self.canvas.bind("<B1-Motion>", self.on_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_release)
         self.canvas.bind("<Motion>", self.on_mouse_move)
 
-        self.mouse_x_line = self.canvas.create_line(0, 0, 0, self.canvas.winfo_height(), fill='darkgrey', dash=(4, 2))
-        self.mouse_y_line = self.canvas.create_line(0, 0, self.canvas.winfo_width(), 0, fill='darkgrey', dash=(4, 2))
+        # initialize_attributes also runs on clear, so drop the previous crosshair and rubber band first
+        self.canvas_items.delete(getattr(self, 'selection_box', None))
+        self.selection_box = None
+        self.canvas_items.delete(getattr(self, 'mouse_x_line', None))
+        self.canvas_items.delete(getattr(self, 'mouse_y_line', None))
+        self.mouse_x_line = self.canvas_items.create('crosshair', 'line', 0, 0, 0, self.canvas.winfo_height(), fill='darkgrey', dash=(4, 2))
+        self.mouse_y_line = self.canvas_items.create('crosshair', 'line', 0, 0, self.canvas.winfo_width(), 0, fill='darkgrey', dash=(4, 2))
 
         
     def open_settings(self, event=None):
@@ -115,7 +1149,18 @@ class MeasurementTool:
     def start_free_drawing(self, event=None):
         self.drawing_mode = "f"
 
+    def start_stroke_drawing(self, event=None):
+        self.drawing_mode = "c"
+
+    def start_group_transform(self, event):
+        self.drawing_mode = event.keysym
+
     def stop_drawing(self, event):
+        # Like a line, a stroke is only kept if the mouse is released while the key is held
+        if self.stroke:
+            self.clear_preview()
+        if self.transform:
+            self.cancel_transform()
         self.drawing_mode = None
         self.start_x, self.start_y = None, None
         self.line_drawn = False
@@ -134,53 +1179,535 @@ class MeasurementTool:
         ------------------
         d: Draw from vertex | 从顶点绘制
         f: Free draw | 自由绘制
+        c: Freehand stroke | 徒手曲线
+        m/r/g + drag: Move/rotate/scale selection | 移动/旋转/缩放所选线条
+        Drag a vertex: Move it | 拖动顶点: 移动顶点
         Shift: Snap to axis | 吸附到轴
         s: Toggle snapping | 切换吸附模式
         Ctrl + z: Undo | 撤销
         Ctrl + r: Clear all | 清除所有
         Escape/Ctrl + w: Exit | 退出
         i: Settings | 设置
+        n: New layer | 新建图层
+        l: Switch layer | 切换图层
+        h: Hide/show layer | 隐藏/显示图层
+        1-9: Hide/show layer N | 隐藏/显示第N个图层
+        b: Raster mode for big scenes | 大场景的栅格模式
+        e: Export picture | 导出图片
+        v: Vanishing points | 灭点
+        a: Statistics | 统计
+        Drag on empty space: Select lines | 在空白处拖动: 框选线条
+        Delete: Delete selected lines | 删除所选线条
         """
         self.shortcuts_label = tk.Label(self.canvas, text=shortcuts, bg='white', justify='left', anchor='nw')
         self.shortcuts_label.place(relx=0, rely=0, anchor='nw')
 
+    def show_layer_status(self):
+        self.layer_label = tk.Label(self.canvas, bg='white', justify='left', anchor='sw')
+        self.layer_label.place(relx=0, rely=1, anchor='sw')
+        self.update_layer_status()
+
+    def update_layer_status(self):
+        """List the layers in the corner, marking the active one and the hidden ones."""
+        rows = []
+        for number, layer in enumerate(self.layers.values(), start=1):
+            marker = '>' if layer is self.active_layer else ' '
+            state = '' if layer.visible else ' (hidden | 已隐藏)'
+            rows.append(f"{marker} {number}: {layer.name}{state}")
+        if self.selected_lines:
+            rows.append(self.selection_summary())
+        self.layer_label.config(text="\n".join(rows))
+
+    @property
+    def reference_line(self):
+        """Reference line of the active layer."""
+        return self.active_layer.reference_line
+
+    @property
+    def reference_line_length(self):
+        """Length of the active layer's reference line."""
+        return self.active_layer.reference_line_length
+
+    def add_layer(self, name=None, color=None, width=2):
+        """Create a layer and return it. Layers are never deleted, only emptied by clear."""
+        number = len(self.layers) + 1
+        name = name or f"Layer {number}"
+        if name in self.layers:
+            raise ValueError(f"layer {name!r} already exists")
+        color = color or self.LAYER_COLORS[(number - 1) % len(self.LAYER_COLORS)]
+        # Canvas tags must stay free of spaces and tag-expression operators
+        layer = Layer(name, f"layer{number}", color=color, width=width)
+        self.layers[name] = layer
+        return layer
+
+    def new_layer(self, event=None):
+        """Create a new layer and draw on it from now on."""
+        self.active_layer = self.add_layer()
+        self.update_layer_status()
+        self.journal_op('layer', name=self.active_layer.name, color=self.active_layer.color, width=self.active_layer.width)
+
+    def cycle_active_layer(self, event=None):
+        layers = list(self.layers.values())
+        self.active_layer = layers[(layers.index(self.active_layer) + 1) % len(layers)]
+        self.update_layer_status()
+
+    def toggle_active_layer(self, event=None):
+        self.toggle_layer(self.active_layer)
+
+    def toggle_layer_by_number(self, event):
+        layers = list(self.layers.values())
+        number = int(event.char)
+        if number <= len(layers):
+            self.toggle_layer(layers[number - 1])
+
+    def toggle_layer(self, layer):
+        if layer.visible:
+            self.hide_layer(layer)
+        else:
+            self.show_layer(layer)
+
+    def hide_layer(self, layer):
+        """Hide every item of the layer; its lines are skipped until it is shown again."""
+        if not layer.visible:
+            return
+        layer.visible = False
+        self.canvas.itemconfigure(layer.tag, state='hidden')
+        # Hidden lines can't stay selected, or Delete would remove lines nobody sees
+        self.select_lines(line for line in self.selected_lines if self.line_data[line]['layer'] is not layer)
+        self.update_layer_status()
+        self.scene_changed()
+
+    def show_layer(self, layer):
+        if layer.visible:
+            return
+        layer.visible = True
+        # In raster mode the layer's items stay hidden and show up in the next image
+        if not self.raster_mode:
+            self.show_scene_items(layer.tag)
+        # Labels could not be kept up to date while hidden
+        if layer.stale:
+            layer.stale = False
+            self.refresh_scene()
+        self.update_layer_status()
+        self.scene_changed()
+
+    def show_scene_items(self, tag):
+        """Show the items matching `tag`, except those also tagged with a hidden layer."""
+        # Purple labels between two layers carry both tags, keep those of other hidden layers hidden
+        hidden_tags = [layer.tag for layer in self.layers.values() if not layer.visible]
+        if hidden_tags:
+            self.canvas.itemconfigure(f"{tag}&&!({'||'.join(hidden_tags)})", state='normal')
+        else:
+            self.canvas.itemconfigure(tag, state='normal')
+
+    def item_state(self, *layers, live=False):
+        """Canvas state for new scene items: hidden in raster mode, unless `live`, or when one of `layers` is hidden."""
+        if (self.raster_mode and not live) or not all(layer.visible for layer in layers):
+            return 'hidden'
+        return 'normal'
+
+    def scene_changed(self):
+        """Note that committed geometry, labels or styles changed, re-rendering the raster once idle."""
+        self.scene_version += 1
+        if self.raster_mode and not self.raster_pending:
+            self.raster_pending = True
+            self.root.after_idle(self.update_raster)
+        self.schedule_perspective_update()
+        if self.statistics_window is not None and not self.statistics_pending:
+            self.statistics_pending = True
+            self.root.after_idle(self.update_statistics)
+
+    def toggle_raster_mode(self, event=None):
+        if self.raster_mode:
+            self.raster_mode = False
+            self.canvas_items.delete(self.raster_item)
+            self.raster_item = None
+            self.raster_photo = None
+            self.raster_version = None
+            self.show_scene_items(self.SCENE_TAG)
+            return
+
+        if Image is None:
+            warnings.warn("Raster mode needs Pillow (pip install pillow)", RuntimeWarning)
+            return
+        self.raster_mode = True
+        self.canvas.itemconfigure(self.SCENE_TAG, state='hidden')
+        self.update_raster()
+
+    def update_raster(self):
+        """Re-render the cached image of the committed scene if it changed since the last render."""
+        self.raster_pending = False
+        if not self.raster_mode or self.raster_version == self.scene_version:
+            return
+        self.raster_version = self.scene_version
+        self.raster_photo = ImageTk.PhotoImage(render_scene_image(self.scene_snapshot(exclude=self.live_lines, selection=True)))
+        if self.raster_item is None:
+            self.raster_item = self.canvas_items.create('raster', 'image', 0, 0, anchor='nw', image=self.raster_photo)
+            # Keep the drag preview, crosshair and highlights drawn on top
+            self.canvas.tag_lower(self.raster_item)
+        else:
+            self.canvas.itemconfigure(self.raster_item, image=self.raster_photo)
+
+    def toggle_perspective_mode(self, event=None):
+        if self.perspective is not None:
+            self.perspective = None
+            self.draw_perspective()
+            return
+        if np is None:
+            warnings.warn("Perspective mode needs NumPy (pip install numpy)", RuntimeWarning)
+            return
+        self.perspective = {'coords': {}, 'groups': [], 'unassigned': [], 'searched': 0, 'added': 0, 'missed': 0, 'unassigned_share': 0.0}
+        self.update_perspective()
+
+    def schedule_perspective_update(self):
+        if self.perspective is not None and not self.perspective_pending:
+            self.perspective_pending = True
+            self.root.after_idle(self.update_perspective)
+
+    def perspective_frame(self):
+        """Center and scale that map canvas coordinates to roughly [-1, 1] for the estimation."""
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        return width / 2, height / 2, max(width, height, 2) / 2
+
+    def update_perspective(self):
+        """Re-estimate the vanishing points of the selected lines, or of all visible lines.
+
+        When lines were only added since the last estimate, each new line joins the vanishing
+        point it misses by the smallest angle and that point is re-solved from its updated
+        normal-equation sums; lines that fit no point are searched for new points once there
+        are enough of them, and a new point that lands on a known one is merged into it.
+        As the incremental answer can drift from what a full search would find, the full
+        search runs again after PERSPECTIVE_REFIT of the lines came in incrementally, when
+        that share more of the new lines fit no point than did after the last full search,
+        and after any other edit.
+        """
+        self.perspective_pending = False
+        perspective = self.perspective
+        if perspective is None:
+            return
+        lines = self.visible_lines()
+        if self.selected_lines:
+            lines = [(line, data) for line, data in lines if line in self.selected_lines]
+        coords = {line: data['coords'] for line, data in lines}
+        known = perspective['coords']
+        added = [line for line in coords if line not in known]
+        unchanged = len(coords) - len(added) == len(known) and all(coords.get(line) == value for line, value in known.items())
+        perspective['coords'] = coords
+
+        frame = self.perspective_frame()
+        search = None
+        if unchanged and perspective['groups'] and perspective['added'] + len(added) <= self.PERSPECTIVE_REFIT * perspective['searched']:
+            if not added:
+                return
+            new_lines, midpoints, directions = perspective_lines([coords[line] for line in added], frame)
+            points = np.array([group['point'] for group in perspective['groups']])
+            residuals = vanishing_point_residuals(points, midpoints, directions)
+            fits = residuals <= sin(radians(self.PERSPECTIVE_TOLERANCE))
+            for index, line in enumerate(added):
+                if not fits[:, index].any():
+                    perspective['unassigned'].append(line)
+                    perspective['missed'] += 1
+                    continue
+                group = perspective['groups'][residuals[:, index].argmin()]
+                group['lines'].append(line)
+                group['normal_matrix'] += np.outer(new_lines[index], new_lines[index])
+                group['point'] = solve_vanishing_point(group['normal_matrix'])
+            perspective['added'] += len(added)
+            # New lines the points don't explain are a sign the points drifted; a few could just be a new point
+            missed = perspective['missed']
+            if missed < 3 or missed <= (perspective['unassigned_share'] + self.PERSPECTIVE_REFIT) * perspective['added']:
+                search = perspective['unassigned']
+        if search is None:
+            perspective.update(groups=[], searched=len(coords), added=0, missed=0)
+            search = list(coords)
+
+        if len(perspective['groups']) < self.MAX_VANISHING_POINTS and search:
+            found = find_vanishing_points(*perspective_lines([coords[line] for line in search], frame),
+                                          max_points=self.MAX_VANISHING_POINTS - len(perspective['groups']),
+                                          tolerance=self.PERSPECTIVE_TOLERANCE)
+            grouped = set()
+            for normal_matrix, members in found:
+                group_lines = [search[index] for index in members]
+                grouped.update(group_lines)
+                point = solve_vanishing_point(normal_matrix)
+                # Points are unit vectors in the estimation frame, so their angle says how close they are
+                same = [group for group in perspective['groups']
+                        if degrees(acos(min(1.0, abs(float(point @ group['point']))))) <= self.PERSPECTIVE_TOLERANCE]
+                if same:
+                    same[0]['lines'].extend(group_lines)
+                    same[0]['normal_matrix'] += normal_matrix
+                    same[0]['point'] = solve_vanishing_point(same[0]['normal_matrix'])
+                else:
+                    perspective['groups'].append({'lines': group_lines, 'normal_matrix': normal_matrix, 'point': point})
+            perspective['unassigned'] = [line for line in search if line not in grouped]
+        if not perspective['added']:
+            perspective['unassigned_share'] = len(perspective['unassigned']) / max(len(coords), 1)
+        self.draw_perspective()
+
+    def vanishing_points(self):
+        """Return the current vanishing points as plain data, biggest group first.
+
+        'point' is the canvas position, or None for lines that stay parallel, whose common
+        direction is then given as 'direction'.
+        """
+        if self.perspective is None:
+            return []
+        center_x, center_y, scale = self.perspective_frame()
+        points = []
+        for group in sorted(self.perspective['groups'], key=lambda group: -len(group['lines'])):
+            x, y, w = group['point']
+            # Farther than a hundred screens away is as good as parallel
+            if abs(w) > 0.01 * hypot(x, y):
+                point, direction = [float(x / w * scale + center_x), float(y / w * scale + center_y)], None
+            else:
+                point, direction = None, [float(x), float(y)]
+            points.append({'point': point, 'direction': direction, 'lines': sorted(group['lines'])})
+        return points
+
+    def draw_perspective(self):
+        """Draw a marker for every vanishing point on the screen's surroundings and the horizon through them."""
+        for item in self.perspective_items:
+            self.canvas_items.delete(item)
+        self.perspective_items = []
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        finite = []
+        for number, vanishing_point in enumerate(self.vanishing_points(), start=1):
+            if vanishing_point['point'] is None:
+                continue
+            x, y = vanishing_point['point']
+            finite.append((x, y))
+            # Canvas coordinates far off screen only waste the canvas' time
+            if -10 * width < x < 11 * width and -10 * height < y < 11 * height:
+                self.perspective_items.append(self.canvas_items.create('perspective', 'oval', x - 7, y - 7, x + 7, y + 7, outline='orange', width=2))
+                self.perspective_items.append(self.canvas_items.create('perspective', 'text', x, y - 18, text=f"VP{number}: {len(vanishing_point['lines'])}", fill='orange', anchor="center"))
+
+        if not finite:
+            return
+        if len(finite) == 1:
+            # One-point perspective: the horizon is level through the vanishing point
+            (x1, y1), (x2, y2) = finite[0], (finite[0][0] + 1, finite[0][1])
+        else:
+            # Of the vanishing points the two most level with each other span the horizon
+            (x1, y1), (x2, y2) = min(combinations(finite, 2), key=lambda pair: abs(self.calculate_line_angle(*pair[0], *pair[1])))
+        if x1 == x2:
+            return
+        slope = (y2 - y1) / (x2 - x1)
+        left_y, right_y = y1 - slope * x1, y1 + slope * (width - x1)
+        self.perspective_items.append(self.canvas_items.create('perspective', 'line', 0, left_y, width, right_y, fill='orange', dash=(8, 4)))
+        tilt = degrees(atan2(y1 - y2, x2 - x1)) if x2 > x1 else degrees(atan2(y2 - y1, x1 - x2))
+        self.perspective_items.append(self.canvas_items.create('perspective', 'text', 80, left_y + slope * 80 - 12, text=f"Horizon | 地平线 {tilt:.1f}°", fill='orange', anchor="center"))
+
+    def toggle_statistics(self, event=None):
+        if self.statistics_window is not None:
+            self.close_statistics()
+            return
+        if np is None:
+            warnings.warn("The statistics panel needs NumPy (pip install numpy)", RuntimeWarning)
+            return
+        # Copy the scene once; from here on index_line and unindex_line keep the copy current
+        self.scene_columns = SceneColumns(max(64, len(self.lines)))
+        for line, data in self.lines:
+            self.scene_columns.set(line, data['coords'], data['layer'])
+        self.statistics_window = StatisticsWindow(self)
+        self.update_statistics()
+
+    def close_statistics(self):
+        if self.statistics_window is not None:
+            self.statistics_window.destroy()
+        self.statistics_window = None
+        self.scene_columns = None
+
+    def update_statistics(self):
+        self.statistics_pending = False
+        if self.statistics_window is not None:
+            self.statistics_window.show(self.scene_columns.statistics())
+
+    def export(self, event=None):
+        """Ask for a file name and export the visible scene, or only the selected lines, as a PNG or SVG picture, or as a .json scene."""
+        path = tkinter.filedialog.asksaveasfilename(
+            parent=self.overlay, title="Export | 导出", defaultextension='.png',
+            filetypes=[("PNG", "*.png"), ("SVG", "*.svg"), ("Scene | 场景", "*.json")])
+        if not path:
+            return
+        try:
+            selected = [(line, data) for line, data in self.visible_lines() if line in self.selected_lines]
+            export_scene(self.scene_snapshot(selected or None), path, scale=self.EXPORT_SCALE)
+        except (RuntimeError, ValueError, OSError) as error:
+            warnings.warn(f"Export failed: {error}", RuntimeWarning)
+
+    def scene_snapshot(self, lines=None, exclude=(), selection=False):
+        """Return the visible committed scene as plain data: lines with their colors and all labels.
+
+        `lines` limits the snapshot to the given (line, data) pairs, leaving out strokes.
+        `exclude` leaves out the given lines and the purple angles they take part in.
+        `selection` gives selected lines the 'dash' they are drawn with on the canvas.
+        """
+        selected = self.visible_lines() if lines is None else lines
+        if exclude:
+            selected = [(line, data) for line, data in selected if line not in exclude]
+        stroke_items = self.strokes.items() if lines is None else ()
+        lines = []
+        labels = []
+        for line, data in selected:
+            layer = data['layer']
+            x1, y1, x2, y2 = data['coords']
+            lines.append({
+                'coords': [x1, y1, x2, y2],
+                'color': 'blue' if layer.reference_line == line else layer.color,
+                'width': layer.width,
+            })
+            if selection and line in self.selected_lines:
+                lines[-1]['dash'] = list(self.SELECTION_DASH)
+            angle = self.calculate_line_angle(x1, y1, x2, y2)
+            labels.append(dict(self.label_style('angle'), text=f"{angle:.1f}°", position=[(x1 + x2) / 2, (y1 + y2) / 2 - 30]))
+            if layer.reference_line_length:
+                ratio = data['length'] / layer.reference_line_length
+                labels.append(dict(self.label_style('ratio'), text=f"{ratio:.2f}", position=list(ratio_label_position(x1, y1, x2, y2))))
+        for (_, data1), (_, data2), common_vertex, angle in self.connected_line_pairs(selected):
+            position = intersection_label_position(common_vertex, data1['coords'], data2['coords'])
+            labels.append(dict(self.label_style('intersection'), text=f"{angle:.1f}°", position=list(position)))
+        strokes = []
+        for stroke, data in stroke_items:
+            layer = data['layer']
+            if not layer.visible:
+                continue
+            strokes.append({'points': [c for point in data['points'] for c in point], 'color': layer.color, 'width': layer.width})
+            label_x, label_y = data['points'][len(data['points']) // 2]
+            text = stroke_label_text(data['arc_length'], data['chord_length'], layer.reference_line_length)
+            labels.append({'text': text, 'position': [label_x, label_y - 20], 'color': 'black'})
+        return {
+            'width': self.canvas.winfo_width(),
+            'height': self.canvas.winfo_height(),
+            'font_size': self.LABEL_FONT_SIZE,
+            'lines': lines,
+            'strokes': strokes,
+            'labels': labels,
+        }
+
+    def label_style(self, kind):
+        """Return the color and font size of a label of `kind` ('angle', 'ratio' or 'intersection') for snapshots."""
+        style = self.label_styles[kind]
+        # The canvas takes size 0 for its default font
+        return {'color': style['color'], 'font_size': style['font_size'] or self.LABEL_FONT_SIZE}
+
+    def label_options(self, kind):
+        """Return the canvas options that draw a label of `kind` in its font size and color."""
+        style = self.label_styles[kind]
+        return {'fill': style['color'], 'font': ('Arial', style['font_size'])}
+
+    def set_label_style(self, kind, font_size=None, color=None):
+        """Change the font size or color of every label of `kind`, now and from now on."""
+        style = self.label_styles[kind]
+        if font_size is not None:
+            style['font_size'] = font_size
+        if color is not None:
+            style['color'] = color
+        options = self.label_options(kind)
+        for item, category in self.canvas_items.items.items():
+            if category == kind:
+                self.canvas.itemconfig(item, **options)
+        self.scene_changed()
+
+    def visible_lines(self):
+        """Return (line, data) of lines on visible layers. Hit-testing, snapping and angles only look at these."""
+        if all(layer.visible for layer in self.layers.values()):
+            return self.lines
+        return [(line, data) for line, data in self.lines if data['layer'].visible]
+
+    def lines_near(self, x, y, radius):
+        """Return (line, data) of visible lines whose bounding box comes within `radius` of (x, y), oldest first."""
+        near = self.segment_index.query(x - radius, y - radius, x + radius, y + radius)
+        # Canvas ids grow, so sorting keeps the order of self.lines
+        return [(line, self.line_data[line]) for line in sorted(near) if self.line_data[line]['layer'].visible]
+
+    def lines_in_box(self, x1, y1, x2, y2):
+        """Return the visible lines crossing the box with corners (x1, y1) and (x2, y2), oldest first."""
+        box = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        return [line for line in sorted(self.segment_index.query(*box))
+                if self.line_data[line]['layer'].visible and segment_intersects_box(*self.line_data[line]['coords'], *box)]
+
+    def nearest_vertex(self, x, y, max_distance, exclude=None):
+        """Return the visible line end point closest to (x, y) within `max_distance`, or None. `exclude` is never returned."""
+        nearest_vertex = None
+        min_distance = max_distance
+        for line, data in self.lines_near(x, y, max_distance):
+            x1, y1, x2, y2 = data['coords']
+            d1 = sqrt((x1 - x)**2 + (y1 - y)**2)
+            d2 = sqrt((x2 - x)**2 + (y2 - y)**2)
+
+            if d1 < min_distance and (x1, y1) != exclude:
+                nearest_vertex = (x1, y1)
+                min_distance = d1
+            if d2 < min_distance and (x2, y2) != exclude:
+                nearest_vertex = (x2, y2)
+                min_distance = d2
+        return nearest_vertex
+
+    def mark_hidden_layers_stale(self):
+        for layer in self.layers.values():
+            if not layer.visible:
+                layer.stale = True
+
     def on_click(self, event):
+        if self.drawing_mode == "c":
+            self.start_stroke(event.x, event.y)
+            return
+
+        if self.drawing_mode in self.TRANSFORM_MODES:
+            self.start_transform(event.x, event.y)
+            return
+
         if self.drawing_mode == "d" and self.selected_vertex:
             self.start_x, self.start_y = self.selected_vertex
         elif self.drawing_mode == "f":
             self.start_x, self.start_y = event.x, event.y
 
         # Check if the click is for selecting/deselecting a vertex or line
-        for line, data in self.lines:
-            x1, y1, x2, y2 = self.canvas.coords(line)
+        for line, data in self.lines_near(event.x, event.y, 10):
+            x1, y1, x2, y2 = data['coords']
             
             # Check for vertices first
             if abs(x1 - event.x) < 10 and abs(y1 - event.y) < 10:
-                self.selected_vertex = (x1, y1)
-                self.update_selected_vertex_highlight()
-                self.toggle_reference_line(line)
+                self.select_vertex((x1, y1), line)
                 return
             elif abs(x2 - event.x) < 10 and abs(y2 - event.y) < 10:
-                self.selected_vertex = (x2, y2)
-                self.update_selected_vertex_highlight()
-                self.toggle_reference_line(line)
+                self.select_vertex((x2, y2), line)
                 return
 
             # Check for line selection
-            coords = self.canvas.coords(line)
-            dist = self.point_to_line_distance(coords, (event.x, event.y))
+            dist = self.point_to_line_distance(data['coords'], (event.x, event.y))
             if dist < 5:
                 self.toggle_reference_line(line)
                 return
 
+        # Outside drawing, a press on empty space starts a rubber band selection
+        if not self.drawing_mode:
+            self.start_box_selection(event.x, event.y)
+
     def on_drag(self, event):
+        if self.drawing_mode == "c":
+            self.extend_stroke(event.x, event.y)
+            return
+
+        if self.selection_start:
+            self.update_box_selection(event.x, event.y)
+            return
+
+        if self.transform:
+            self.update_transform(event.x, event.y)
+            return
+
+        if self.vertex_drag:
+            self.update_vertex_drag(event.x, event.y)
+            return
+
         # If not in drawing mode or start coordinates are not defined, simply return
         if not self.drawing_mode or self.start_x is None or self.start_y is None:
             return
         
         # If there's a current line being drawn, remove it
         if self.current_line:
-            self.canvas.delete(self.current_line)
+            self.canvas_items.delete(self.current_line)
 
         # If SHIFT is held or in snapping mode, adjust the end point
         if self.shift_held:
@@ -196,7 +1723,7 @@ class MeasurementTool:
                 event.x, event.y = nearest_vertex
 
         # Create a new line
-        self.current_line = self.canvas.create_line(self.start_x, self.start_y, event.x, event.y, width=2)
+        self.current_line = self.canvas_items.create('preview', 'line', self.start_x, self.start_y, event.x, event.y, width=2)
         self.line_drawn = True
         
 
@@ -208,8 +1735,8 @@ class MeasurementTool:
             midpoint_x = (self.start_x + event.x) / 2
             midpoint_y = (self.start_y + event.y) / 2
             if self.ratio_display:
-                self.canvas.delete(self.ratio_display)
-            self.ratio_display = self.canvas.create_text(midpoint_x, midpoint_y, text=f"{ratio:.2f}", anchor="center")
+                self.canvas_items.delete(self.ratio_display)
+            self.ratio_display = self.canvas_items.create('preview', 'text', midpoint_x, midpoint_y, text=f"{ratio:.2f}", anchor="center", **self.label_options('ratio'))
 
 
 
@@ -218,8 +1745,8 @@ class MeasurementTool:
         angle = self.calculate_line_angle(self.start_x, self.start_y, event.x, event.y)
         angle_text = f"{angle:.1f}°"
         if self.angle_display:
-            self.canvas.delete(self.angle_display)
-        self.angle_display = self.canvas.create_text((self.start_x + event.x) / 2, (self.start_y + event.y) / 2 - 30, text=angle_text, anchor="center", fill="red")
+            self.canvas_items.delete(self.angle_display)
+        self.angle_display = self.canvas_items.create('preview', 'text', (self.start_x + event.x) / 2, (self.start_y + event.y) / 2 - 30, text=angle_text, anchor="center", **self.label_options('angle'))
 
         # If there's a currently drawn line, check for intersections and display angles
         if self.line_drawn:
@@ -234,6 +1761,22 @@ class MeasurementTool:
         self.snapping_mode = not self.snapping_mode
 
     def on_release(self, event):
+        if self.drawing_mode == "c":
+            self.finish_stroke(event.x, event.y)
+            return
+
+        if self.selection_start:
+            self.finish_box_selection(event.x, event.y)
+            return
+
+        if self.transform:
+            self.finish_transform(event.x, event.y)
+            return
+
+        if self.vertex_drag:
+            self.finish_vertex_drag()
+            return
+
         if not self.line_drawn:
             return
         
@@ -266,79 +1809,565 @@ class MeasurementTool:
 
         # If it's a simple click without dragging, return early
         if length < 2:
+            self.clear_preview()
             return
 
+        # Drawing on a hidden layer brings it back
+        self.show_layer(self.active_layer)
+
          # Store the line data and make the end point of the line the currently selected vertex
-        line_data = {'coords': (self.start_x, self.start_y, event.x, event.y), 'length': length, 'ratio_display': None, 'angle_display': None}
-        self.lines.append((self.current_line, line_data))
-        self.selected_vertex = (event.x, event.y)
+        self.commit_line(self.start_x, self.start_y, event.x, event.y, line=self.current_line)
         self.current_line = None
 
         self.selected_vertex = (self.end_x, self.end_y)
         self.update_selected_vertex_highlight()
 
-        if len(self.lines) == 1:
-            self.set_reference_line(self.lines[0][0])
+        # Remove the temporary ratio, angle and intersection displays
+        self.clear_preview()
 
-        # Remove the temporary ratio display
-        if self.ratio_display:
-            self.canvas.delete(self.ratio_display)
-            self.ratio_display = None
+        # Update ratios and intersection angles for all lines
+        self.refresh_scene()
 
-        # Remove the temporary angle display
-        if self.angle_display:
-            self.canvas.delete(self.angle_display)
-            self.angle_display = None
+        self.highlight_nearby_vertex(event.x, event.y)
 
-        # Delete temporary intersection angles
-        if self.temp_intersection_angles:
-            for angle_display in self.temp_intersection_angles:
-                self.canvas.delete(angle_display)
-            self.temp_intersection_angles = []
+    def select_vertex(self, vertex, line):
+        """Select a clicked vertex of `line`. A click toggles the line as reference; outside drawing, a drag moves the vertex instead."""
+        self.selected_vertex = vertex
+        self.update_selected_vertex_highlight()
+        if self.drawing_mode:
+            self.toggle_reference_line(line)
+            return
+        lines = sorted(other for other in self.vertex_lines[vertex] if self.line_data[other]['layer'].visible)
+        self.vertex_drag = {
+            'vertex': vertex,
+            'position': vertex,
+            'dragged': False,
+            'line': line,
+            'lines': lines,
+            'coords': [self.line_data[other]['coords'] for other in lines],
+        }
+
+    def update_vertex_drag(self, x, y):
+        """Move the dragged vertex to (x, y); only the lines ending there and their labels are updated."""
+        drag = self.vertex_drag
+        vertex_x, vertex_y = drag['vertex']
+        # A shaky click shouldn't move the vertex
+        if not drag['dragged']:
+            if hypot(x - vertex_x, y - vertex_y) < 3:
+                return
+            drag['dragged'] = True
+            self.start_live_lines(drag['lines'])
+        if self.shift_held:
+            if abs(x - vertex_x) > abs(y - vertex_y):
+                y = vertex_y
+            else:
+                x = vertex_x
+        elif self.snapping_mode:
+            # Snapping onto another vertex joins the two
+            nearest_vertex = self.nearest_vertex(x, y, 15, exclude=drag['position'])
+            if nearest_vertex:
+                x, y = nearest_vertex
+
+        coords = []
+        for x1, y1, x2, y2 in drag['coords']:
+            if (x1, y1) == drag['vertex']:
+                x1, y1 = x, y
+            if (x2, y2) == drag['vertex']:
+                x2, y2 = x, y
+            # Like drawing, never shrink a line below 2 pixels
+            if sqrt((x2 - x1)**2 + (y2 - y1)**2) < 2:
+                return
+            coords.append((x1, y1, x2, y2))
+        self.move_lines(drag['lines'], coords)
+        drag['position'] = (x, y)
+        self.selected_vertex = (x, y)
+        self.update_selected_vertex_highlight()
+        self.update_mouse_axis_lines(x, y)
+
+    def finish_vertex_drag(self):
+        drag = self.vertex_drag
+        self.vertex_drag = None
+        if not drag['dragged']:
+            # A click rather than a drag
+            self.toggle_reference_line(drag['line'])
+            return
+        self.stop_live_lines()
+        if drag['position'] == drag['vertex']:
+            return
+        self.record_move(drag['lines'], drag['coords'])
+        if self.CHECK_ITEMS:
+            self.check_item_budget()
+
+    def start_box_selection(self, x, y):
+        self.selection_start = (x, y)
+        self.canvas_items.delete(self.selection_box)
+        self.selection_box = self.canvas_items.create('selection', 'rectangle', x, y, x, y, outline='orange', dash=(4, 2))
+
+    def update_box_selection(self, x, y):
+        self.canvas.coords(self.selection_box, *self.selection_start, x, y)
+        self.update_mouse_axis_lines(x, y)
+
+    def finish_box_selection(self, x, y):
+        """Select the lines crossing the rubber band. Shift adds to the selection, a plain click clears it."""
+        x0, y0 = self.selection_start
+        self.selection_start = None
+        self.canvas_items.delete(self.selection_box)
+        self.selection_box = None
+        lines = self.lines_in_box(x0, y0, x, y) if abs(x - x0) >= 2 or abs(y - y0) >= 2 else []
+        if self.shift_held:
+            lines = self.selected_lines.union(lines)
+        self.select_lines(lines)
+
+    def select_lines(self, lines):
+        """Make `lines` the selection; selected lines are drawn dashed."""
+        lines = set(lines)
+        for line in self.selected_lines - lines:
+            if line in self.line_data:
+                self.canvas.itemconfig(line, dash='')
+        for line in lines - self.selected_lines:
+            self.canvas.itemconfig(line, dash=self.SELECTION_DASH)
+        changed = lines != self.selected_lines
+        self.selected_lines = lines
+        self.update_layer_status()
+        # The raster draws the dashes too, and perspective mode only looks at the selection when there is one
+        if changed:
+            self.scene_changed()
+
+    def selection_summary(self):
+        """Status row for the selection: how many lines and their summed length in reference lengths."""
+        total = 0
+        for line in self.selected_lines:
+            data = self.line_data[line]
+            reference_length = data['layer'].reference_line_length
+            if not reference_length:
+                return f"Selected | 已选: {len(self.selected_lines)}"
+            total += data['length'] / reference_length
+        return f"Selected | 已选: {len(self.selected_lines)}, total | 总计 {total:.2f}"
+
+    def delete_selected_lines(self, event=None):
+        if not self.selected_lines:
+            return
+        self.delete_lines(self.selected_lines)
+        self.refresh_scene()
+
+    def start_transform(self, x, y):
+        """Begin moving, rotating or scaling the selected lines, pivoting about the selection's center."""
+        if not self.selected_lines:
+            return
+        if np is None:
+            warnings.warn("Group transforms need NumPy (pip install numpy)", RuntimeWarning)
+            return
+        lines = sorted(self.selected_lines)
+        coords = np.array([self.line_data[line]['coords'] for line in lines], dtype=float)
+        xs, ys = coords[:, 0::2], coords[:, 1::2]
+        self.transform = {
+            'mode': self.drawing_mode,
+            'lines': lines,
+            'coords': coords,
+            'start': (x, y),
+            'pivot': ((xs.min() + xs.max()) / 2, (ys.min() + ys.max()) / 2),
+        }
+        self.start_live_lines(lines)
+
+    def update_transform(self, x, y):
+        transform = self.transform
+        matrix = group_transform_matrix(transform['mode'], transform['pivot'], transform['start'], (x, y))
+        # Always transform the original coordinates so errors don't add up over the drag
+        self.move_lines(transform['lines'], transform_segments(transform['coords'], matrix))
+        self.update_mouse_axis_lines(x, y)
+
+    def finish_transform(self, x, y):
+        if (x, y) == self.transform['start']:
+            # Released where it was pressed: nothing moved, so leave no undo entry behind
+            self.cancel_transform()
+            return
+        self.update_transform(x, y)
+        transform = self.transform
+        self.transform = None
+        self.stop_live_lines()
+        self.record_move(transform['lines'], transform['coords'].tolist())
+        if self.CHECK_ITEMS:
+            self.check_item_budget()
+
+    def record_move(self, lines, previous_coords):
+        """Make a finished move of `lines` undoable and record it in the journal."""
+        self.undo_stack.append(('move', list(zip(lines, map(tuple, previous_coords)))))
+        self.journal_op('move', lines=[self.line_data[line]['uid'] for line in lines],
+                        coords=[list(self.line_data[line]['coords']) for line in lines],
+                        previous=[list(coords) for coords in previous_coords])
+
+    def cancel_transform(self):
+        """Put the lines of an unfinished transform back where they were."""
+        transform = self.transform
+        self.transform = None
+        self.move_lines(transform['lines'], transform['coords'])
+        self.stop_live_lines()
+
+    def start_live_lines(self, lines):
+        """Draw `lines` and their labels as vector items while they are dragged.
+
+        In raster mode the raster is rendered once without them, so a drag frame only moves
+        their canvas items; move_lines leaves scene_changed() to stop_live_lines.
+        """
+        self.live_lines = set(lines)
+        if self.raster_mode:
+            self.set_line_items_state(self.live_lines, 'normal')
+            self.scene_changed()
+
+    def stop_live_lines(self):
+        """Hand the dragged lines back to the scene, re-rendering the raster once with them."""
+        live_lines, self.live_lines = self.live_lines, set()
+        self.scene_changed()
+        if self.raster_mode:
+            # Render before hiding the vector items so the lines never disappear
+            self.update_raster()
+            self.set_line_items_state(live_lines, 'hidden')
+
+    def set_line_items_state(self, lines, state):
+        """Show or hide `lines` with their red, ratio and purple labels."""
+        for line in lines:
+            data = self.line_data[line]
+            for item in (line, data['angle_display'], data['ratio_display'], *data['intersection_angles'].values()):
+                if item:
+                    self.canvas.itemconfigure(item, state=state)
+
+    def move_lines(self, lines, coords):
+        """Give `lines` new end points, one (x1, y1, x2, y2) row each, updating only what depends on them.
+
+        The lines, their red angles, ratios and the purple angles at their end points are updated
+        in place. Other lines are only touched when a moved line is their layer's reference.
+        """
+        lengths, angles, ratio_positions = segment_measurements(coords)
+        coords = coords.tolist() if hasattr(coords, 'tolist') else coords
+        resized_layers = set()
+        for line, new_coords, length, angle in zip(lines, coords, lengths, angles):
+            data = self.line_data[line]
+            self.unindex_line(line)
+            x1, y1, x2, y2 = data['coords'] = tuple(new_coords)
+            data['length'] = length
+            self.index_line(line)
+            self.canvas.coords(line, x1, y1, x2, y2)
+            self.canvas.coords(data['angle_display'], (x1 + x2) / 2, (y1 + y2) / 2 - 30)
+            self.set_label_text(data, 'angle', f"{angle:.1f}°")
+            layer = data['layer']
+            if layer.reference_line == line and layer.reference_line_length != length:
+                layer.reference_line_length = length
+                resized_layers.add(layer)
+
+        for line, position in zip(lines, ratio_positions):
+            data = self.line_data[line]
+            if data['ratio_display'] and data['layer'] not in resized_layers:
+                self.canvas.coords(data['ratio_display'], *position)
+                self.set_label_text(data, 'ratio', f"{data['length'] / data['layer'].reference_line_length:.2f}")
+        # A resized reference changes every ratio of its layer
+        for layer in resized_layers:
+            for line in layer.lines:
+                data = self.line_data[line]
+                if data['ratio_display']:
+                    self.canvas.coords(data['ratio_display'], *ratio_label_position(*data['coords']))
+                    self.set_label_text(data, 'ratio', f"{data['length'] / layer.reference_line_length:.2f}")
+        if resized_layers:
+            self.update_stroke_labels()
+
+        self.update_intersection_labels(lines)
+        if not self.live_lines:
+            self.scene_changed()
+
+    def set_label_text(self, data, kind, text):
+        """Set the text of a line's 'angle' or 'ratio' label, skipping the canvas call if it is unchanged."""
+        if data.get(kind + '_text') != text:
+            data[kind + '_text'] = text
+            self.canvas.itemconfig(data[kind + '_display'], text=text)
+
+    def index_line(self, line):
+        """Add the line to the segment and vertex indexes under its current end points."""
+        x1, y1, x2, y2 = coords = self.line_data[line]['coords']
+        self.segment_index.insert(line, coords)
+        if self.scene_columns is not None:
+            self.scene_columns.set(line, coords, self.line_data[line]['layer'])
+        self.vertex_lines.setdefault((x1, y1), set()).add(line)
+        self.vertex_lines.setdefault((x2, y2), set()).add(line)
+
+    def unindex_line(self, line):
+        x1, y1, x2, y2 = self.line_data[line]['coords']
+        self.segment_index.remove(line)
+        if self.scene_columns is not None:
+            self.scene_columns.remove(line)
+        for vertex in ((x1, y1), (x2, y2)):
+            lines = self.vertex_lines.get(vertex)
+            if lines is not None:
+                lines.discard(line)
+                if not lines:
+                    del self.vertex_lines[vertex]
+
+    def start_stroke(self, x, y):
+        """Begin recording a freehand stroke at (x, y)."""
+        self.clear_preview()
+        self.show_layer(self.active_layer)
+        layer = self.active_layer
+        self.stroke = StrokeSimplifier(x, y)
+        self.current_line = self.canvas_items.create('preview', 'line', x, y, x, y, width=layer.width, fill=layer.color)
+
+    def extend_stroke(self, x, y):
+        """Add a pointer position to the stroke being drawn and update its preview."""
+        if not self.stroke:
+            return
+        self.stroke.add(x, y)
+        # The preview only ever holds the simplified points
+        self.canvas.coords(self.current_line, *self.stroke.preview_points())
+        text = stroke_label_text(self.stroke.length(), self.stroke.chord_length(), self.reference_line_length)
+        if self.ratio_display:
+            self.canvas.coords(self.ratio_display, x, y - 30)
+            self.canvas.itemconfig(self.ratio_display, text=text)
+        else:
+            self.ratio_display = self.canvas_items.create('preview', 'text', x, y - 30, text=text, anchor="center")
+        self.update_mouse_axis_lines(x, y)
 
-       
+    def finish_stroke(self, x, y):
+        """Finish the stroke being drawn at (x, y) and keep it if it is long enough."""
+        if not self.stroke:
+            return
+        self.stroke.add(x, y)
+        points = self.stroke.finish()
+        arc_length = self.stroke.length()
+        stroke = self.current_line
+        self.current_line = None
+        self.clear_preview()
+        if arc_length < 2:
+            self.canvas_items.delete(stroke)
+            return
+        self.commit_stroke(points, arc_length, stroke=stroke)
+        self.scene_changed()
+
+    def commit_stroke(self, points, arc_length, stroke=None, layer=None, uid=None):
+        """Store a finished stroke given as [(x, y), ...] and draw its label, returning its polyline item."""
+        layer = layer or self.active_layer
+        state = self.item_state(layer)
+        tags = (layer.tag, self.SCENE_TAG)
+        flat_points = [c for point in points for c in point]
+        if stroke is None:
+            stroke = self.canvas_items.create('stroke', 'line', *flat_points, width=layer.width, fill=layer.color, tags=tags, state=state)
+        else:
+            self.canvas.coords(stroke, *flat_points)
+            self.canvas.itemconfig(stroke, fill=layer.color, width=layer.width, state=state)
+            for tag in tags:
+                self.canvas.addtag_withtag(tag, stroke)
+            self.canvas_items.set_category(stroke, 'stroke')
+
+        (x1, y1), (x2, y2) = points[0], points[-1]
+        label_x, label_y = points[len(points) // 2]
+        data = {
+            'points': [tuple(point) for point in points],
+            'arc_length': arc_length,
+            'chord_length': hypot(x2 - x1, y2 - y1),
+            'layer': layer,
+        }
+        text = stroke_label_text(arc_length, data['chord_length'], layer.reference_line_length)
+        data['label'] = self.canvas_items.create('stroke', 'text', label_x, label_y - 20, text=text, anchor="center", tags=tags, state=state)
+        data['uid'] = self.assign_uid(uid)
+        self.strokes[stroke] = data
+        self.stroke_uids[data['uid']] = stroke
+        self.undo_stack.append(('stroke', stroke))
+        self.journal_op('stroke', uid=data['uid'], points=[list(point) for point in data['points']], arc_length=arc_length, layer=layer.name)
+        return stroke
+
+    def remove_stroke(self, stroke):
+        data = self.strokes.pop(stroke)
+        del self.stroke_uids[data['uid']]
+        self.canvas_items.delete(stroke)
+        self.canvas_items.delete(data['label'])
+
+    def update_stroke_labels(self):
+        """Update stroke labels after a reference line changed."""
+        for stroke, data in self.strokes.items():
+            layer = data['layer']
+            if layer.visible:
+                text = stroke_label_text(data['arc_length'], data['chord_length'], layer.reference_line_length)
+                self.canvas.itemconfig(data['label'], text=text)
+
+    def commit_line(self, x1, y1, x2, y2, line=None, layer=None, uid=None, record=True):
+        """Store a finished line and draw its angle label, returning the line's canvas item.
+
+        `line` is the preview line drawn during a drag; when omitted a new line item is created.
+        The line goes to `layer`, or the active layer when omitted.
+        Ratios and intersection angles are not refreshed here so that many lines can be added
+        at once; call refresh_scene() after committing. `uid` is only given when restoring a line.
+        With record=False the line stays out of the undo stack and the journal, for lines
+        brought back by undo.
+        """
+        layer = layer or self.active_layer
+        state = self.item_state(layer)
+        tags = (layer.tag, self.SCENE_TAG)
+        if line is None:
+            line = self.canvas_items.create('line', 'line', x1, y1, x2, y2, width=layer.width, fill=layer.color, tags=tags, state=state)
+        else:
+            # The preview may lag behind a snapped end point
+            self.canvas.coords(line, x1, y1, x2, y2)
+            self.canvas.itemconfig(line, fill=layer.color, width=layer.width, state=state)
+            for tag in tags:
+                self.canvas.addtag_withtag(tag, line)
+            self.canvas_items.set_category(line, 'line')
+
+        length = sqrt((x2 - x1)**2 + (y2 - y1)**2)
+        # intersection_angles maps each connected line to the purple label the two share
+        line_data = {'coords': (x1, y1, x2, y2), 'length': length, 'ratio_display': None, 'angle_display': None, 'layer': layer, 'intersection_angles': {}}
+        line_data['uid'] = self.assign_uid(uid)
+        self.lines.append((line, line_data))
+        self.line_data[line] = line_data
+        self.line_uids[line_data['uid']] = line
+        self.index_line(line)
+        layer.lines.add(line)
+        if record:
+            self.undo_stack.append(('line', line))
 
         # Calculate and display the angle in relation to the horizontal axis
-        angle = self.calculate_line_angle(self.start_x, self.start_y, event.x, event.y)
-        angle_text = f"{angle:.1f}°"
-        angle_display = self.canvas.create_text((self.start_x + event.x) / 2, (self.start_y + event.y) / 2 - 30, text=angle_text, anchor="center", fill="red")
-        line_data['angle_display'] = angle_display
+        angle = self.calculate_line_angle(x1, y1, x2, y2)
+        angle_text = line_data['angle_text'] = f"{angle:.1f}°"
+        line_data['angle_display'] = self.canvas_items.create('angle', 'text', (x1 + x2) / 2, (y1 + y2) / 2 - 30, text=angle_text, anchor="center", tags=tags, state=state, **self.label_options('angle'))
 
+        if record:
+            self.journal_op('line', uid=line_data['uid'], coords=[x1, y1, x2, y2], layer=layer.name)
+
+        # The first line of a layer becomes its reference
+        if len(layer.lines) == 1:
+            self.set_reference_line(line)
+        return line
+
+    def assign_uid(self, uid=None):
+        """Return the uid for a new line or stroke: `uid` when restoring one, otherwise the next free one."""
+        if uid is None:
+            uid = self.next_uid
+        self.next_uid = max(self.next_uid, uid + 1)
+        return uid
+
+    def delete_lines(self, lines):
+        """Remove lines as an edit of their own: undoable, and recorded in the journal unlike removals by undo. Call refresh_scene() afterwards."""
+        lines = set(lines)
+        deleted = [(line, data['uid'], data['coords'], data['layer']) for line, data in self.lines if line in lines]
+        if not deleted:
+            return []
+        layers = {layer for _, _, _, layer in deleted}
+        # Deleting a reference line changes its layer's ratios, so undo has to put the reference back too
+        references = [(layer, self.line_data[layer.reference_line]['uid'] if layer.reference_line else None) for layer in layers]
+        removed = self.remove_lines(lines)
+        self.undo_stack.append(('remove', {'lines': deleted, 'references': references}))
+        self.journal_op('remove', lines=[uid for _, uid, _, _ in deleted])
+        return removed
+
+    def restore_lines(self, deleted):
+        """Bring back lines taken out by delete_lines with their uids and reference lines. Call refresh_scene() afterwards."""
+        restored = {}
+        for old_line, uid, coords, layer in deleted['lines']:
+            restored[old_line] = self.commit_line(*coords, layer=layer, uid=uid, record=False)
+        for layer, uid in deleted['references']:
+            if uid is None:
+                self.remove_reference_line(layer)
+            elif layer.reference_line != self.line_uids[uid]:
+                self.set_reference_line(self.line_uids[uid])
+        # Older undo entries still name the restored lines by their previous canvas items
+        for index, (kind, item) in enumerate(self.undo_stack):
+            if kind == 'line' and item in restored:
+                self.undo_stack[index] = ('line', restored[item])
+            elif kind == 'move':
+                self.undo_stack[index] = ('move', [(restored.get(line, line), coords) for line, coords in item])
+
+    def remove_lines(self, lines_to_remove):
+        """Delete the given lines and their labels. Call refresh_scene() afterwards."""
+        lines_to_remove = set(lines_to_remove)
+        removed = [(line, data) for line, data in self.lines if line in lines_to_remove]
+        self.lines = [(line, data) for line, data in self.lines if line not in lines_to_remove]
+
+        if self.transform and lines_to_remove.intersection(self.transform['lines']):
+            self.transform = None
+        if self.vertex_drag and lines_to_remove.intersection(self.vertex_drag['lines']):
+            self.vertex_drag = None
+
+        for line, line_data in removed:
+            # Delete the purple labels shared with other lines
+            for other in list(line_data['intersection_angles']):
+                self.delete_intersection_label(line, other)
+            self.unindex_line(line)
+            del self.line_data[line]
+            del self.line_uids[line_data['uid']]
+            line_data['layer'].lines.discard(line)
+
+            # Delete the line
+            self.canvas_items.delete(line)
+
+            # Delete the associated ratio display, if it exists
+            if line_data['ratio_display']:
+                self.canvas_items.delete(line_data['ratio_display'])
+
+            # Delete the associated angle display, if it exists
+            if line_data['angle_display']:
+                self.canvas_items.delete(line_data['angle_display'])
+
+            # If the reference line is deleted, remove it as reference
+            if line_data['layer'].reference_line == line:
+                self.remove_reference_line(line_data['layer'])
+
+        if self.selected_lines & lines_to_remove:
+            self.selected_lines -= lines_to_remove
+            self.update_layer_status()
+        return [line for line, _ in removed]
+
+    def refresh_scene(self):
+        """Recompute ratios and intersection angles after lines were added or removed."""
         # Update ratios for all lines
         self.update_all_ratios()
         # Update intersection angles for all lines
-        self.update_intersection_angles()
-        # Update intersection angles for all lines
         self.update_all_intersection_angles()
 
-        self.highlight_nearby_vertex(event.x, event.y)
+        self.scene_changed()
+
+        if self.CHECK_ITEMS:
+            self.check_item_budget()
+
+    def clear_preview(self):
+        """Delete the line being drawn together with its temporary ratio, angle and intersection labels."""
+        self.canvas_items.delete(self.current_line)
+        self.current_line = None
+        self.canvas_items.delete(self.ratio_display)
+        self.ratio_display = None
+        self.canvas_items.delete(self.angle_display)
+        self.angle_display = None
+        self.stroke = None
+        for angle_display in self.temp_intersection_angles:
+            self.canvas_items.delete(angle_display)
+        self.temp_intersection_angles = []
+
+    def check_item_budget(self, strict=False):
+        """Compare live canvas items against what the current lines need.
+
+        Returns a report {category: (live, allowed)} of the categories over budget, plus an
+        'untracked' entry for items created without the registry. An empty dict means no leak.
+        With strict=True a leak raises RuntimeError (useful in tests), otherwise it warns.
+        """
+        report = self.canvas_items.over_budget(self.lines, self.strokes)
+        untracked = self.canvas_items.untracked()
+        if untracked:
+            report['untracked'] = (len(untracked), 0)
+        if report:
+            details = ", ".join(f"{category}: {live} > {allowed}" for category, (live, allowed) in sorted(report.items()))
+            message = f"Canvas item budget exceeded with {len(self.lines)} lines ({details})"
+            if strict:
+                raise RuntimeError(message)
+            warnings.warn(message, RuntimeWarning, stacklevel=2)
+        return report
 
     def on_mouse_move(self, event):
         # Remove previous vertex highlights
         if self.vertex_highlight:
-            self.canvas.delete(self.vertex_highlight)
+            self.canvas_items.delete(self.vertex_highlight)
             self.vertex_highlight = None
 
-        nearest_vertex = None
-        min_distance = float('inf')
-
         # Check for nearby vertices and highlight them
-        for line, data in self.lines:
-            x1, y1, x2, y2 = self.canvas.coords(line)
-            d1 = sqrt((x1 - event.x)**2 + (y1 - event.y)**2)
-            d2 = sqrt((x2 - event.x)**2 + (y2 - event.y)**2)
-
-            if d1 < 10 and d1 < min_distance:
-                nearest_vertex = (x1, y1)
-                min_distance = d1
-            if d2 < 10 and d2 < min_distance:
-                nearest_vertex = (x2, y2)
-                min_distance = d2
+        nearest_vertex = self.nearest_vertex(event.x, event.y, 10)
 
         # Only create the yellow highlight if it's not the currently selected vertex
         if nearest_vertex and nearest_vertex != self.selected_vertex:
             x, y = nearest_vertex
-            self.vertex_highlight = self.canvas.create_oval(x-5, y-5, x+5, y+5, fill='yellow')
+            self.vertex_highlight = self.canvas_items.create('highlight', 'oval', x-5, y-5, x+5, y+5, fill='yellow')
 
         self.update_mouse_axis_lines(event.x, event.y)
 
@@ -351,99 +2380,95 @@ class MeasurementTool:
     def highlight_nearby_vertex(self, x, y):
         # Remove previous vertex highlights
         if self.vertex_highlight:
-            self.canvas.delete(self.vertex_highlight)
+            self.canvas_items.delete(self.vertex_highlight)
             self.vertex_highlight = None
 
-        nearest_vertex = None
-        min_distance = float('inf')
-
         # Check for nearby vertices and highlight them
-        for line, data in self.lines:
-            x1, y1, x2, y2 = self.canvas.coords(line)
-            d1 = sqrt((x1 - x)**2 + (y1 - y)**2)
-            d2 = sqrt((x2 - x)**2 + (y2 - y)**2)
-
-            if d1 < 10 and d1 < min_distance:
-                nearest_vertex = (x1, y1)
-                min_distance = d1
-            if d2 < 10 and d2 < min_distance:
-                nearest_vertex = (x2, y2)
-                min_distance = d2
-
-        
+        nearest_vertex = self.nearest_vertex(x, y, 10)
 
         # Only create the yellow highlight if it's not the currently selected vertex
         if nearest_vertex and nearest_vertex != self.selected_vertex:
             x, y = nearest_vertex
-            self.vertex_highlight = self.canvas.create_oval(x-5, y-5, x+5, y+5, fill='yellow')
+            self.vertex_highlight = self.canvas_items.create('highlight', 'oval', x-5, y-5, x+5, y+5, fill='yellow')
 
     def exit_program(self, event):
+        if self.server:
+            self.server.stop()
+        if self.journal:
+            self.journal.close()
         self.root.destroy()
 
     def update_selected_vertex_highlight(self):
         # Remove previous selected vertex highlight
         if self.selected_vertex_highlight:
-            self.canvas.delete(self.selected_vertex_highlight)
+            self.canvas_items.delete(self.selected_vertex_highlight)
             self.selected_vertex_highlight = None
             
         # Highlight the selected vertex in green
         if self.selected_vertex:
             x, y = self.selected_vertex
-            self.selected_vertex_highlight = self.canvas.create_oval(x-5, y-5, x+5, y+5, fill='green')
+            self.selected_vertex_highlight = self.canvas_items.create('highlight', 'oval', x-5, y-5, x+5, y+5, fill='green')
 
     def point_to_line_distance(self, line_coords, point):
         """Calculate shortest distance between a point and a line segment."""
-        x1, y1, x2, y2 = line_coords
-        px, py = point
-        line_len = sqrt((x2 - x1)**2 + (y2 - y1)**2)
-        if line_len == 0:
-            return sqrt((x1 - px)**2 + (y1 - py)**2)
-        t = ((px - x1) * (x2 - x1) + (py - y1) * (y2 - y1)) / line_len**2
-        t = max(0, min(1, t))
-        proj_x = x1 + t * (x2 - x1)
-        proj_y = y1 + t * (y2 - y1)
-        return sqrt((proj_x - px)**2 + (proj_y - py)**2)
+        return point_segment_distance(*point, *line_coords)
 
     def set_reference_line(self, line):
-        if self.reference_line:
-            self.remove_reference_line()
-        self.reference_line = line
-        self.canvas.itemconfig(self.reference_line, fill='blue')
-        _, data = next((l, d) for l, d in self.lines if l == self.reference_line)
-        self.reference_line_length = data['length']
+        """Make the line the reference of its own layer."""
+        data = self.line_data[line]
+        layer = data['layer']
+        if layer.reference_line:
+            self.remove_reference_line(layer)
+        layer.reference_line = line
+        self.canvas.itemconfig(line, fill='blue')
+        layer.reference_line_length = data['length']
 
         # Update ratios for all lines
         self.update_all_ratios()
+        self.scene_changed()
 
 
 
-    def remove_reference_line(self):
-        if self.reference_line:
-            self.canvas.itemconfig(self.reference_line, fill='black')
-            self.reference_line = None
-            self.reference_line_length = None
+    def remove_reference_line(self, layer=None):
+        """Remove the reference line of `layer`, or of the active layer when omitted."""
+        layer = layer or self.active_layer
+        if layer.reference_line:
+            self.canvas.itemconfig(layer.reference_line, fill=layer.color)
+            layer.reference_line = None
+            layer.reference_line_length = None
 
             # Update ratios for all lines
             self.update_all_ratios()
+            self.scene_changed()
 
     def toggle_reference_line(self, line):
-        if self.reference_line == line:
-            self.remove_reference_line()
+        layer = self.line_data[line]['layer']
+        if layer.reference_line == line:
+            self.remove_reference_line(layer)
         else:
             self.set_reference_line(line)
+        self.journal_reference(layer)
+
+    def journal_reference(self, layer):
+        reference = self.line_data[layer.reference_line]['uid'] if layer.reference_line else None
+        self.journal_op('reference', layer=layer.name, line=reference)
 
     def update_all_ratios(self):
-        for line, data in self.lines:
+        self.mark_hidden_layers_stale()
+        for line, data in self.visible_lines():
+            layer = data['layer']
             x1, y1, x2, y2 = data['coords']
             if 'ratio_display' in data and data['ratio_display']:
-                self.canvas.delete(data['ratio_display'])
+                self.canvas_items.delete(data['ratio_display'])
 
-            if self.reference_line_length:
-                ratio = data['length'] / self.reference_line_length
+            # Ratios are measured against the reference line of the line's own layer
+            if layer.reference_line_length:
+                ratio = data['length'] / layer.reference_line_length
                 midpoint_x = (x1 + x2) / 2
                 midpoint_y = (y1 + y2) / 2
                 # Display ratio above the line to avoid overlap
-                data['ratio_display'] = self.canvas.create_text(midpoint_x, midpoint_y - 10, text=f"{ratio:.2f}", anchor="center")
+                data['ratio_text'] = f"{ratio:.2f}"
+                data['ratio_display'] = self.canvas_items.create('ratio', 'text', midpoint_x, midpoint_y - 10, text=data['ratio_text'], anchor="center", tags=(layer.tag, self.SCENE_TAG), state=self.item_state(layer), **self.label_options('ratio'))
             else:
                 data['ratio_display'] = None
              # Update the position of the ratio text
@@ -452,84 +2477,74 @@ class MeasurementTool:
             midpoint_y = (y1 + y2) / 2
             if data['ratio_display']:
                 self.update_ratio_position(x1, y1, x2, y2, midpoint_x, midpoint_y, data['ratio_display'])
+
+        self.update_stroke_labels()
         
     def update_ratio_position(self, x1, y1, x2, y2, midpoint_x, midpoint_y, text_obj):
         """Determine the optimal position for the ratio text based on the line's orientation."""
-
-        angle = degrees(atan2(y2 - y1, x2 - x1))
-        if -45 <= angle <= 45:
-            # Horizontal-ish line
-            self.canvas.coords(text_obj, midpoint_x, midpoint_y - 20)
-        elif 45 < angle < 135:
-            # Vertical-ish line (positive slope)
-            self.canvas.coords(text_obj, midpoint_x - 20, midpoint_y)
-        elif -135 < angle < -45:
-            # Vertical-ish line (negative slope)
-            self.canvas.coords(text_obj, midpoint_x + 20, midpoint_y)
-        else:
-            # Horizontal-ish line (but inverted)
-            self.canvas.coords(text_obj, midpoint_x, midpoint_y + 20)
+        self.canvas.coords(text_obj, *ratio_label_position(x1, y1, x2, y2))
 
     def undo_last_action(self, event=None):
-        """Undo the last drawn or modified line."""
-        if self.lines:
-            line_to_remove, line_data = self.lines.pop()
-            
-            # Delete the line
-            self.canvas.delete(line_to_remove)
-            
-            # Delete the associated ratio display, if it exists
-            if line_data['ratio_display']:
-                self.canvas.delete(line_data['ratio_display'])
-
-            # Delete the associated angle display, if it exists
-            if line_data['angle_display']:
-                self.canvas.delete(line_data['angle_display'])
-
-            # Delete intersection angles, if they exist
-            if 'intersection_angles' in line_data:
-                for angle_display in line_data['intersection_angles']:
-                    self.canvas.delete(angle_display)
-
-
-            # If the reference line is deleted, remove it as reference
-            if self.reference_line == line_to_remove:
-                self.remove_reference_line()
-
-            # Update ratios for all remaining lines
-            self.update_all_ratios()
-
-            self.update_all_intersection_angles()
-
+        """Undo the last drawn, moved or deleted lines."""
+        # Entries for lines or strokes already removed some other way are skipped
+        while self.undo_stack:
+            kind, item = self.undo_stack.pop()
+            if kind == 'line' and item in self.line_data:
+                self.remove_lines([item])
+
+                # Update ratios and intersection angles for all remaining lines
+                self.refresh_scene()
+                self.journal_op('undo')
+                return
+            if kind == 'stroke' and item in self.strokes:
+                self.remove_stroke(item)
+                self.scene_changed()
+                self.journal_op('undo')
+                return
+            if kind == 'move':
+                moved = [(line, coords) for line, coords in item if line in self.line_data]
+                if moved:
+                    self.move_lines(*map(list, zip(*moved)))
+                    self.journal_op('undo')
+                    return
+            if kind == 'remove':
+                self.restore_lines(item)
+                self.refresh_scene()
+                self.journal_op('undo')
+                return
 
     def clear_screen(self, event=None):
         """Clear all lines and reset the tool's state."""
         for line, line_data in self.lines:
             # Delete the line
-            self.canvas.delete(line)
+            self.canvas_items.delete(line)
             
             # Delete the associated ratio display, if it exists
             if line_data['ratio_display']:
-                self.canvas.delete(line_data['ratio_display'])
+                self.canvas_items.delete(line_data['ratio_display'])
           
             if line_data['angle_display']:
-                self.canvas.delete(line_data['angle_display'])
+                self.canvas_items.delete(line_data['angle_display'])
 
-            for _, data in self.lines:
-                if 'intersection_angles' in data:
-                    for angle_display in data['intersection_angles']:
-                        self.canvas.delete(angle_display)
+            # Each purple label is shared by two lines, delete it once
+            for other, angle_display in line_data['intersection_angles'].items():
+                if other > line:
+                    self.canvas_items.delete(angle_display)
 
+        for stroke in list(self.strokes):
+            self.remove_stroke(stroke)
 
+        # Delete the line being drawn and its temporary labels
+        self.clear_preview()
 
         # Delete vertex highlights
         if self.vertex_highlight:
-            self.canvas.delete(self.vertex_highlight)
+            self.canvas_items.delete(self.vertex_highlight)
             self.vertex_highlight = None
             
         # Delete selected vertex highlights
         if self.selected_vertex_highlight:
-            self.canvas.delete(self.selected_vertex_highlight)
+            self.canvas_items.delete(self.selected_vertex_highlight)
             self.selected_vertex_highlight = None
 
         # Clear the list of lines
@@ -540,6 +2555,12 @@ class MeasurementTool:
         
         # Reinitialize the tool's attributes
         self.initialize_attributes()
+        self.update_layer_status()
+        self.scene_changed()
+        self.journal_op('clear')
+
+        if self.CHECK_ITEMS:
+            self.check_item_budget()
 
     def calculate_line_angle(self, x1, y1, x2, y2):
         """Determine the angle of the line in relation to the horizontal axis (0° to 90°)."""
@@ -548,40 +2569,6 @@ class MeasurementTool:
         angle = abs(degrees(atan2(dy, dx)))
         return angle if angle <= 90 else 180 - angle
 
-    def update_intersection_angles(self):
-        # Clear previous intersection angles
-        for _, data in self.lines:
-            if 'intersection_angles' in data:
-                for angle_display in data['intersection_angles']:
-                    self.canvas.delete(angle_display)
-                data['intersection_angles'] = []
-
-        # Check every pair of lines for intersections
-        for (line1, data1), (line2, data2) in combinations(self.lines, 2):
-            x1, y1, x2, y2 = data1['coords']
-            x3, y3, x4, y4 = data2['coords']
-
-            # Check for common vertex and calculate angle
-            common_vertex = None
-            if (x1, y1) == (x3, y3):
-                common_vertex = (x1, y1)
-            elif (x1, y1) == (x4, y4):
-                common_vertex = (x1, y1)
-            elif (x2, y2) == (x3, y3):
-                common_vertex = (x2, y2)
-            elif (x2, y2) == (x4, y4):
-                common_vertex = (x2, y2)
-            
-            if common_vertex:
-                angle = self.angle_between_two_lines((x1, y1, x2, y2), (x3, y3, x4, y4))
-                angle_text = f"{angle:.1f}°"
-                angle_display = self.canvas.create_text(common_vertex[0], common_vertex[1] - 20, text=angle_text, anchor="center", fill="purple")
-                if 'intersection_angles' not in data1:
-                    data1['intersection_angles'] = []
-                data1['intersection_angles'].append(angle_display)
-
-  
-
     def angle_between_two_lines(self, line1, line2):
         x1, y1, x2, y2 = line1
         x3, y3, x4, y4 = line2
@@ -622,10 +2609,11 @@ class MeasurementTool:
         # Clear previous temporary intersection angles
         if self.temp_intersection_angles:
             for angle_display in self.temp_intersection_angles: 
-                self.canvas.delete(angle_display)
+                self.canvas_items.delete(angle_display)
             self.temp_intersection_angles = []
 
-        for line, data in self.lines:
+        # Only lines whose box holds the start point can share it
+        for line, data in self.lines_near(self.start_x, self.start_y, 0):
             x1, y1, x2, y2 = data['coords']
             common_vertex = None
             if (x1, y1) == (self.start_x, self.start_y):
@@ -640,65 +2628,107 @@ class MeasurementTool:
                 angle_text = f"{angle:.1f}°"
                 offset_x = (common_vertex[0] + x) / 2
                 offset_y = (common_vertex[1] + y) / 2 - 20
-                angle_display = self.canvas.create_text(offset_x, offset_y, text=angle_text, anchor="center", fill="purple")
+                angle_display = self.canvas_items.create('preview', 'text', offset_x, offset_y, text=angle_text, anchor="center", **self.label_options('intersection'))
                 if not self.temp_intersection_angles:
                     self.temp_intersection_angles = []
                 self.temp_intersection_angles.append(angle_display)
 
     def update_all_intersection_angles(self):
-        # Clear previous intersection angles
-        for _, data in self.lines:
-            if 'intersection_angles' in data:
-                for angle_display in data['intersection_angles']:
-                    self.canvas.delete(angle_display)
-                data['intersection_angles'] = []
-
-        for (line1, data1), (line2, data2) in combinations(self.lines, 2):
-            x1, y1, x2, y2 = data1['coords']
-            x3, y3, x4, y4 = data2['coords']
-
-            common_vertex = None
-            if (x1, y1) == (x3, y3):
-                common_vertex = (x1, y1)
-            elif (x1, y1) == (x4, y4):
-                common_vertex = (x1, y1)
-            elif (x2, y2) == (x3, y3):
-                common_vertex = (x2, y2)
-            elif (x2, y2) == (x4, y4):
-                common_vertex = (x2, y2)
+        # Lines on hidden layers are skipped and refreshed when their layer is shown
+        self.mark_hidden_layers_stale()
 
+        # Clear previous intersection angles
+        for line, data in self.visible_lines():
+            for other in list(data['intersection_angles']):
+                self.delete_intersection_label(line, other)
+
+        for (line1, data1), (line2, data2), common_vertex, angle in self.connected_line_pairs():
+            position = intersection_label_position(common_vertex, data1['coords'], data2['coords'])
+            self.set_intersection_label(line1, line2, angle, position)
+
+    def update_intersection_labels(self, lines):
+        """Recompute the purple labels of pairs involving `lines` only, using the vertex index."""
+        # Pairs with lines on hidden layers are dropped and rebuilt when the layer is shown
+        self.mark_hidden_layers_stale()
+        pairs = set()
+        for line in lines:
+            data = self.line_data[line]
+            x1, y1, x2, y2 = data['coords']
+            connected = set()
+            if data['layer'].visible:
+                for vertex in ((x1, y1), (x2, y2)):
+                    connected.update(other for other in self.vertex_lines.get(vertex, ())
+                                     if other != line and self.line_data[other]['layer'].visible)
+            for other in list(data['intersection_angles']):
+                if other not in connected:
+                    self.delete_intersection_label(line, other)
+            # Pairs are ordered like self.lines, the way connected_line_pairs yields them
+            pairs.update((min(line, other), max(line, other)) for other in connected)
+
+        pairs = sorted(pairs)
+        coords1 = [self.line_data[line1]['coords'] for line1, _ in pairs]
+        coords2 = [self.line_data[line2]['coords'] for _, line2 in pairs]
+        vertices = [shared_vertex(c1, c2) for c1, c2 in zip(coords1, coords2)]
+        if np is not None and len(pairs) > 16:
+            angles, positions = pair_measurements(coords1, coords2, vertices)
+        else:
+            angles = [self.angle_between_two_lines(c1, c2) for c1, c2 in zip(coords1, coords2)]
+            positions = [intersection_label_position(*args) for args in zip(vertices, coords1, coords2)]
+        for (line1, line2), angle, position in zip(pairs, angles, positions):
+            self.set_intersection_label(line1, line2, angle, position)
+
+    def set_intersection_label(self, line1, line2, angle, position):
+        """Create or update the purple label of two connected lines."""
+        data1, data2 = self.line_data[line1], self.line_data[line2]
+        angle_text = f"{angle:.1f}°"
+        angle_display = data1['intersection_angles'].get(line2)
+        if angle_display:
+            self.canvas.coords(angle_display, *position)
+            if self.intersection_texts[angle_display] != angle_text:
+                self.intersection_texts[angle_display] = angle_text
+                self.canvas.itemconfig(angle_display, text=angle_text)
+            return
+        # Tag with both layers so hiding either one hides the label
+        tags = (data1['layer'].tag, data2['layer'].tag, self.SCENE_TAG)
+        state = self.item_state(data1['layer'], data2['layer'], live=line1 in self.live_lines or line2 in self.live_lines)
+        angle_display = self.canvas_items.create('intersection', 'text', *position, text=angle_text, anchor="center", tags=tags, state=state, **self.label_options('intersection'))
+        data1['intersection_angles'][line2] = data2['intersection_angles'][line1] = angle_display
+        self.intersection_texts[angle_display] = angle_text
+
+    def delete_intersection_label(self, line1, line2):
+        angle_display = self.line_data[line1]['intersection_angles'].pop(line2)
+        self.line_data[line2]['intersection_angles'].pop(line1)
+        self.intersection_texts.pop(angle_display)
+        self.canvas_items.delete(angle_display)
+
+    def connected_line_pairs(self, lines=None):
+        """Yield ((line1, data1), (line2, data2), common_vertex, angle) for every pair of visible lines sharing a vertex.
+
+        `lines` limits the pairs to the given (line, data) pairs.
+        """
+        lines = self.visible_lines() if lines is None else lines
+        # Group lines by end point so only lines that can share a vertex get compared
+        incident = {}
+        for index, (_, data) in enumerate(lines):
+            x1, y1, x2, y2 = data['coords']
+            incident.setdefault((x1, y1), []).append(index)
+            if (x2, y2) != (x1, y1):
+                incident.setdefault((x2, y2), []).append(index)
+        candidates = set()
+        for indices in incident.values():
+            candidates.update(combinations(indices, 2))
+
+        for i, j in sorted(candidates):
+            (line1, data1), (line2, data2) = lines[i], lines[j]
+            common_vertex = shared_vertex(data1['coords'], data2['coords'])
             if common_vertex:
-                angle = self.angle_between_two_lines((x1, y1, x2, y2), (x3, y3, x4, y4))
-                # if angle > 90:
-                #     angle = 180 - angle
-                angle_text = f"{angle:.1f}°"
-                offset_x = (common_vertex[0] + (x1 + x2 + x3 + x4) / 4) / 2
-                offset_y = (common_vertex[1] + (y1 + y2 + y3 + y4) / 4) / 2 - 20
-                angle_display = self.canvas.create_text(offset_x, offset_y, text=angle_text, anchor="center", fill="purple")
-                if 'intersection_angles' not in data1:
-                    data1['intersection_angles'] = []
-                data1['intersection_angles'].append(angle_display)
+                angle = self.angle_between_two_lines(data1['coords'], data2['coords'])
+                yield (line1, data1), (line2, data2), common_vertex, angle
 
     def get_nearest_vertex(self, x, y):
         """Return the nearest vertex if within snapping distance, otherwise return None."""
         SNAP_DISTANCE = 15  # Define a threshold for snapping
-        nearest_vertex = None
-        min_distance = float('inf')
-        
-        for line, data in self.lines:
-            x1, y1, x2, y2 = self.canvas.coords(line)
-            
-            d1 = sqrt((x1 - x)**2 + (y1 - y)**2)
-            d2 = sqrt((x2 - x)**2 + (y2 - y)**2)
-            
-            if d1 < SNAP_DISTANCE and d1 < min_distance:
-                nearest_vertex = (x1, y1)
-                min_distance = d1
-            if d2 < SNAP_DISTANCE and d2 < min_distance:
-                nearest_vertex = (x2, y2)
-                min_distance = d2
-                
-        return nearest_vertex
+        return self.nearest_vertex(x, y, SNAP_DISTANCE)
     
     def shift_pressed(self, event):
         self.shift_held = True
@@ -706,6 +2736,210 @@ class MeasurementTool:
     def shift_released(self, event):
         self.shift_held = False
 
+    def measure_lines(self, lines=None):
+        """Return lengths, ratios and angles of the given lines (all lines when None) as plain data."""
+        wanted = None if lines is None else set(lines)
+        measurements = []
+        for line, data in self.lines:
+            if wanted is not None and line not in wanted:
+                continue
+            x1, y1, x2, y2 = data['coords']
+            layer = data['layer']
+            measurements.append({
+                'line': line,
+                'coords': [x1, y1, x2, y2],
+                'length': data['length'],
+                'ratio': data['length'] / layer.reference_line_length if layer.reference_line_length else None,
+                'angle': self.calculate_line_angle(x1, y1, x2, y2),
+                'reference': line == layer.reference_line,
+                'layer': layer.name,
+            })
+        intersections = [
+            {'lines': [line1, line2], 'vertex': list(common_vertex), 'angle': angle}
+            for (line1, _), (line2, _), common_vertex, angle in self.connected_line_pairs()
+            if wanted is None or line1 in wanted or line2 in wanted
+        ]
+        strokes = []
+        for stroke, data in self.strokes.items():
+            layer = data['layer']
+            strokes.append({
+                'stroke': stroke,
+                'points': [list(point) for point in data['points']],
+                'arc_length': data['arc_length'],
+                'ratio': data['arc_length'] / layer.reference_line_length if layer.reference_line_length else None,
+                'chord_to_arc': data['chord_length'] / data['arc_length'],
+                'layer': layer.name,
+            })
+        return {'lines': measurements, 'intersections': intersections, 'strokes': strokes}
+
+    def set_line_width(self, width):
+        """Give every layer, and so every line, the same thickness."""
+        # New lines are drawn with the layer's width
+        for layer in self.layers.values():
+            layer.width = width
+        for line, data in self.lines:
+            self.canvas.itemconfig(line, width=width)
+        self.scene_changed()
+        self.journal_op('width', width=width)
+
+    def open_journal(self, directory):
+        """Restore the scene journaled in `directory`, then record every further edit there.
+
+        A journal that can't be restored is moved aside with a warning and the scene starts empty.
+        """
+        journal = OperationJournal(directory)
+        try:
+            snapshot, entries = journal.load()
+            # The journal is attached only afterwards, so restoring doesn't journal anything
+            if snapshot:
+                self.load_scene_state(snapshot)
+            for entry in entries:
+                self.replay(entry)
+        except JournalLockedError:
+            raise
+        except Exception as error:
+            # Say a line or layer the entries name is missing: that shouldn't make every start fail
+            aside = journal.set_aside()
+            warnings.warn(f"Couldn't restore the journal in {directory} ({error!r}), moved it to {aside} and started empty", RuntimeWarning)
+            self.clear_screen()
+        self.refresh_scene()
+        self.update_layer_status()
+        # Start over from a fresh snapshot, which also drops a journal tail torn by a crash
+        journal.write_snapshot(self.scene_state())
+        self.journal = journal
+        return journal
+
+    def journal_op(self, op, **fields):
+        """Record an edit in the journal, if one is open, and make sure it gets synced soon."""
+        if not self.journal:
+            return
+        self.journal.append(op, **fields)
+        if not self.journal_sync_pending:
+            self.journal_sync_pending = True
+            self.root.after(OperationJournal.FSYNC_INTERVAL, self.sync_journal)
+
+    def sync_journal(self):
+        self.journal_sync_pending = False
+        if not self.journal:
+            return
+        self.journal.sync()
+        # Drags change coordinates before they are journaled, so compact between them
+        if self.journal.needs_compaction() and not (self.transform or self.vertex_drag):
+            self.journal.write_snapshot(self.scene_state())
+
+    def replay(self, entry):
+        """Apply one journal entry again."""
+        op = entry['op']
+        if op == 'line':
+            self.commit_line(*entry['coords'], layer=self.layers[entry['layer']], uid=entry['uid'])
+        elif op == 'stroke':
+            points = [tuple(point) for point in entry['points']]
+            self.commit_stroke(points, entry['arc_length'], layer=self.layers[entry['layer']], uid=entry['uid'])
+        elif op == 'remove':
+            self.delete_lines([self.line_uids[uid] for uid in entry['lines'] if uid in self.line_uids])
+        elif op == 'move':
+            lines = [self.line_uids[uid] for uid in entry['lines']]
+            self.move_lines(lines, entry['coords'])
+            self.record_move(lines, entry['previous'])
+        elif op == 'reference':
+            layer = self.layers[entry['layer']]
+            if entry['line'] is None:
+                self.remove_reference_line(layer)
+            else:
+                self.set_reference_line(self.line_uids[entry['line']])
+        elif op == 'undo':
+            self.undo_last_action()
+        elif op == 'clear':
+            self.clear_screen()
+        elif op == 'layer':
+            self.active_layer = self.layers.get(entry['name']) or self.add_layer(entry['name'], entry['color'], entry['width'])
+        elif op == 'width':
+            self.set_line_width(entry['width'])
+
+    def scene_state(self):
+        """Return everything needed to rebuild the scene, with lines and strokes named by uid."""
+        # Deleted lines keep their entries while undo can still bring them back
+        deleted_uids = {line: uid for kind, item in self.undo_stack if kind == 'remove' for line, uid, _, _ in item['lines']}
+        uids = lambda line: self.line_data[line]['uid'] if line in self.line_data else deleted_uids.get(line)
+        undo = []
+        for kind, item in self.undo_stack:
+            # Entries of other removed lines and strokes would be skipped by undo anyway
+            if kind == 'line' and uids(item) is not None:
+                undo.append(['line', uids(item)])
+            elif kind == 'stroke' and item in self.strokes:
+                undo.append(['stroke', self.strokes[item]['uid']])
+            elif kind == 'move':
+                moved = [[uids(line), list(coords)] for line, coords in item if uids(line) is not None]
+                if moved:
+                    undo.append(['move', moved])
+            elif kind == 'remove':
+                undo.append(['remove', {
+                    'lines': [[uid, list(coords), layer.name] for _, uid, coords, layer in item['lines']],
+                    'references': [[layer.name, uid] for layer, uid in item['references']],
+                }])
+        return {
+            'next_uid': self.next_uid,
+            'active_layer': self.active_layer.name,
+            'layers': [{
+                'name': layer.name,
+                'color': layer.color,
+                'width': layer.width,
+                'reference': self.line_data[layer.reference_line]['uid'] if layer.reference_line else None,
+            } for layer in self.layers.values()],
+            'lines': [{'uid': data['uid'], 'coords': list(data['coords']), 'layer': data['layer'].name} for _, data in self.lines],
+            'strokes': [{
+                'uid': data['uid'],
+                'points': [list(point) for point in data['points']],
+                'arc_length': data['arc_length'],
+                'layer': data['layer'].name,
+            } for data in self.strokes.values()],
+            'undo': undo,
+        }
+
+    def load_scene_state(self, state):
+        """Rebuild a scene from scene_state() on top of the current one. Call refresh_scene() afterwards."""
+        for layer_state in state['layers']:
+            layer = self.layers.get(layer_state['name']) or self.add_layer(layer_state['name'])
+            layer.color = layer_state['color']
+            layer.width = layer_state['width']
+        for line_state in state['lines']:
+            self.commit_line(*line_state['coords'], layer=self.layers[line_state['layer']], uid=line_state['uid'])
+        for stroke_state in state['strokes']:
+            points = [tuple(point) for point in stroke_state['points']]
+            self.commit_stroke(points, stroke_state['arc_length'], layer=self.layers[stroke_state['layer']], uid=stroke_state['uid'])
+        for layer_state in state['layers']:
+            layer = self.layers[layer_state['name']]
+            if layer_state['reference'] is None:
+                self.remove_reference_line(layer)
+            elif layer.reference_line != self.line_uids[layer_state['reference']]:
+                self.set_reference_line(self.line_uids[layer_state['reference']])
+
+        self.undo_stack = []
+        # Deleted lines have no canvas item yet, a ('uid', uid) key stands in until undo restores them
+        lines = lambda uid: self.line_uids.get(uid, ('uid', uid))
+        for kind, item in state['undo']:
+            if kind == 'line':
+                self.undo_stack.append(('line', lines(item)))
+            elif kind == 'stroke':
+                self.undo_stack.append(('stroke', self.stroke_uids[item]))
+            elif kind == 'move':
+                self.undo_stack.append(('move', [(lines(uid), tuple(coords)) for uid, coords in item]))
+            else:
+                self.undo_stack.append(('remove', {
+                    'lines': [(lines(uid), uid, tuple(coords), self.layers[layer]) for uid, coords, layer in item['lines']],
+                    'references': [(self.layers[layer], uid) for layer, uid in item['references']],
+                }))
+        self.next_uid = max(self.next_uid, state['next_uid'])
+        self.active_layer = self.layers[state['active_layer']]
+
+    def start_server(self, host='127.0.0.1', port=0, path=None):
+        """Start a MeasurementServer for this overlay and return it."""
+        if self.server:
+            self.server.stop()
+        self.server = MeasurementServer(self, host=host, port=port, path=path)
+        self.server.start()
+        return self.server
+
 class SettingsWindow(tk.Toplevel):
     def __init__(self, parent):
         super().__init__(parent.overlay)
@@ -759,26 +2993,26 @@ class SettingsWindow(tk.Toplevel):
         self.font_size_label = tk.Label(self.settings_frame, text="Font Size for Angles | 角度的字体大小:")
         self.font_size_label.pack(anchor='w', padx=10, pady=5)
         self.font_size_slider = tk.Scale(self.settings_frame, from_=0, to_=40, orient="horizontal", command=self.apply_font_size)
-        self.font_size_slider.set(12)  # default value
+        self.font_size_slider.set(self.parent.label_styles['angle']['font_size'])
         self.font_size_slider.pack(anchor='w', padx=10, pady=5, fill="x")
 
         # Font Size for Ratio
         self.ratio_font_size_label = tk.Label(self.settings_frame, text="Font Size for Ratio | 比率的字体大小:")
         self.ratio_font_size_label.pack(anchor='w', padx=10, pady=5)
         self.ratio_font_size_slider = tk.Scale(self.settings_frame, from_=0, to_=40, orient="horizontal", command=self.apply_ratio_font_size)
-        self.ratio_font_size_slider.set(12)  # default value
+        self.ratio_font_size_slider.set(self.parent.label_styles['ratio']['font_size'])
         self.ratio_font_size_slider.pack(anchor='w', padx=10, pady=5, fill="x")
 
         # Font Size for Intersection Angles
         self.intersection_font_size_label = tk.Label(self.settings_frame, text="Font Size for Intersection Angles | 交点角度的字体大小:")
         self.intersection_font_size_label.pack(anchor='w', padx=10, pady=5)
         self.intersection_font_size_slider = tk.Scale(self.settings_frame, from_=0, to_=40, orient="horizontal", command=self.apply_intersection_font_size)
-        self.intersection_font_size_slider.set(12)  # default value
+        self.intersection_font_size_slider.set(self.parent.label_styles['intersection']['font_size'])
         self.intersection_font_size_slider.pack(anchor='w', padx=10, pady=5, fill="x")
 
         # Font Color for Angles
         self.font_colors = ["red", "green", "blue", "black"]
-        self.font_color_var = tk.StringVar(value=self.font_colors[0])
+        self.font_color_var = tk.StringVar(value=self.parent.label_styles['angle']['color'])
         self.font_color_label = tk.Label(self.settings_frame, text="Font Color for Angles | 角度的字体颜色:")
         self.font_color_label.pack(anchor='w', padx=10, pady=5)
         for color in self.font_colors:
@@ -848,12 +3082,17 @@ class SettingsWindow(tk.Toplevel):
         - Draw Lines:
         Press and hold 'd' to start drawing from a selected vertex. | 按住 'd' 从所选的顶点开始绘制。
         Press and hold 'f' to start free drawing from any point. | 按住 'f' 从任意点开始自由绘制。
+        Press and hold 'c' to draw a freehand stroke; it shows its length ratio and chord/arc ratio. | 按住 'c' 徒手绘制曲线，显示其长度比例和弦长/弧长比。
         Use 'Shift' key to snap the line to horizontal or vertical. | 使用 'Shift' 键将线条对齐到水平或垂直。
 
         - Select and Measure:
         Click on a line's end to select. | 点击线的端点进行选择。
+        Drag a line's end to move the vertex; all lines ending there follow. | 拖动线的端点移动顶点，连接到该顶点的线都会跟随。
         Lines display the angle with horizontal. | 线显示与水平线的角度。
         Intersecting lines show the angle of intersection. | 相交线显示相交角。
+        Drag on empty space to select the lines in a box, hold 'Shift' to add to the selection. | 在空白处拖动框选线条，按住 'Shift' 加选。
+        Selected lines are dashed; 'Delete' removes them and 'e' exports only them. | 所选线条显示为虚线，按 'Delete' 删除，按 'e' 只导出所选线条。
+        Hold 'm', 'r' or 'g' and drag to move, rotate or scale the selection about its center (needs NumPy). | 按住 'm'、'r' 或 'g' 拖动，以所选线条的中心移动、旋转或缩放 (需要 NumPy)。
 
         - Reference Line:
         Click on a line to set as reference. The line turns blue. | 点击一条线将其设置为参考线，该线会变为蓝色。
@@ -862,6 +3101,31 @@ class SettingsWindow(tk.Toplevel):
 
         - Snapping Mode:
         Press 's' to toggle snapping mode. | 按 's' 切换对齐模式。
+
+        - Layers:
+        Press 'n' to start a new layer, 'l' to switch the layer you draw on. | 按 'n' 新建图层，按 'l' 切换绘制所在的图层。
+        Each layer has its own reference line and color. | 每个图层有自己的参考线和颜色。
+        Press 'h' to hide/show the current layer, or '1'-'9' for layer N. | 按 'h' 隐藏/显示当前图层，或按 '1'-'9' 隐藏/显示第N个图层。
+        Hidden layers are kept but can't be selected or snapped to. | 隐藏的图层会保留，但不能被选中或吸附。
+
+        - Raster Mode:
+        Press 'b' to draw finished lines and labels as one picture, which keeps big scenes fast. | 按 'b' 把已完成的线和标注绘制成一张图片，使大场景保持流畅。
+        Needs Pillow (pip install pillow). | 需要安装 Pillow (pip install pillow)。
+
+        - Perspective:
+        Press 'v' to find the vanishing points of the selected lines, or of all lines, and draw the horizon. | 按 'v' 找出所选线条 (或全部线条) 的灭点并画出地平线。
+        Lines aiming at the same point are grouped by themselves; stray lines are left out. | 指向同一点的线会自动分组，不相关的线会被忽略。
+        Needs NumPy (pip install numpy). | 需要安装 NumPy (pip install numpy)。
+
+        - Statistics:
+        Press 'a' to open a panel with histograms of the line angles and of the ratios to the reference line. | 按 'a' 打开统计面板，显示线条角度和与参考线之比的直方图。
+        It also lists the most common proportions and the angle sums where lines meet, and updates as you draw. | 面板还列出最常见的比例和线条相交处的角度和，并随绘制实时更新。
+        Needs NumPy (pip install numpy). | 需要安装 NumPy (pip install numpy)。
+
+        - Export:
+        Press 'e' to save the visible lines and labels as a PNG or SVG picture, or as a .json scene. | 按 'e' 将可见的线和标注保存为 PNG 或 SVG 图片，或保存为 .json 场景。
+        Saved scenes can be rendered in bulk at any size without opening the overlay: | 保存的场景可以不打开覆盖层，以任意尺寸批量导出:
+        python MeasureTool.py --export a.json b.json --scale 2 --scale 4 --format png --format svg --out handouts
         
         - Undo & Clear:
         Press 'Ctrl + z' to undo last action. | 按 'Ctrl + z' 撤销上一个操作。
@@ -872,6 +3136,12 @@ class SettingsWindow(tk.Toplevel):
 
         - Settings:
         Press 'i' to open settings. | 按 'i' 打开设置。
+
+        - Recovery:
+        Every edit is saved to ~/.measuretool, so after a crash or restart your lines come back. | 每次编辑都会保存到 ~/.measuretool，崩溃或重启后线条会恢复。
+        Press 'Ctrl + r' to start over; run with '--no-journal' to start empty without saving. | 按 'Ctrl + r' 重新开始；使用 '--no-journal' 启动则不保存也不恢复。
+        Only one overlay saves there at a time; a second one starts without saving. | 同一时间只有一个覆盖层保存到该处，第二个启动时不会保存。
+        A save that can't be restored is moved to a 'broken-...' folder there and the overlay starts empty. | 无法恢复的保存会被移到该处的 'broken-...' 文件夹，覆盖层从空白开始。
         
         - Creator's note|作者留言:
         This little tool is created by Tim Chen 2023 inspired by DoudouTown drawing exercise. 
@@ -898,26 +3168,16 @@ class SettingsWindow(tk.Toplevel):
         self.parent.overlay.attributes('-alpha', float(value))
 
     def apply_line_thickness(self, value):
-        for line, data in self.parent.lines:
-            self.parent.canvas.itemconfig(line, width=float(value))
+        self.parent.set_line_width(float(value))
 
     def apply_font_size(self, value):
-        font_size = int(value)
-        for line, data in self.parent.lines:
-            if 'angle_display' in data and data['angle_display']:
-                self.parent.canvas.itemconfig(data['angle_display'], font=('Arial', font_size))
+        self.parent.set_label_style('angle', font_size=int(value))
 
     def apply_ratio_font_size(self, value):
-        font_size = int(value)
-        for line, data in self.parent.lines:
-            if 'ratio_display' in data and data['ratio_display']:
-                self.parent.canvas.itemconfig(data['ratio_display'], font=('Arial', font_size))
+        self.parent.set_label_style('ratio', font_size=int(value))
 
     def apply_font_color(self):
-        color = self.font_color_var.get()
-        for line, data in self.parent.lines:
-            if 'angle_display' in data and data['angle_display']:
-                self.parent.canvas.itemconfig(data['angle_display'], fill=color)
+        self.parent.set_label_style('angle', color=self.font_color_var.get())
 
     def check_close(self, event=None):
         # Check if the click event happened outside the window
@@ -926,13 +3186,341 @@ class SettingsWindow(tk.Toplevel):
                     self.winfo_y() < event.y_root < self.winfo_y() + self.winfo_height()):
                 self.destroy()
     def apply_intersection_font_size(self, value):
-        font_size = int(value)
-        for line, data in self.parent.lines:
-            if 'intersection_angles' in data and data['intersection_angles']:
-                self.parent.canvas.itemconfig(data['intersection_angles'], font=('Arial', font_size))
+        self.parent.set_label_style('intersection', font_size=int(value))
+
+
+class StatisticsWindow(tk.Toplevel):
+    """Panel with angle and proportion statistics of the visible lines, refreshed after every edit."""
+
+    BAR_WIDTH = 30  # characters of the longest histogram bar
+    MAX_ROWS = 10  # proportions and vertices listed
+
+    def __init__(self, parent):
+        super().__init__(parent.overlay)
+        self.title("Statistics | 统计")
+        self.parent = parent
+        self.text = tk.Text(self, width=60, height=40, font=('Courier', 10))
+        self.text.pack(expand=True, fill='both')
+        self.protocol("WM_DELETE_WINDOW", parent.close_statistics)
+
+    def histogram_rows(self, labels, counts):
+        largest = max(counts) or 1
+        return [f"  {label:<10} {'█' * round(self.BAR_WIDTH * count / largest):<{self.BAR_WIDTH}} {count}" for label, count in zip(labels, counts)]
+
+    def show(self, statistics):
+        rows = [f"Lines on visible layers | 可见图层的线条: {statistics['count']}", ""]
+
+        rows.append("Angle with horizontal | 与水平线的角度")
+        labels = [f"{low}-{high}°" for low, high in zip(ANGLE_BINS, ANGLE_BINS[1:])]
+        rows += self.histogram_rows(labels, statistics['angles'])
+
+        rows += ["", "Length / reference | 长度与参考线之比"]
+        if statistics['quartiles'] is None:
+            rows.append("  No reference line | 没有参考线")
+        else:
+            low, median, high = statistics['quartiles']
+            rows.append(f"  median | 中位数 {median:.2f}, quartiles | 四分位数 {low:.2f} - {high:.2f}")
+            labels = [f"{low:g}-{high:g}" for low, high in zip(RATIO_BINS, RATIO_BINS[1:])]
+            rows += self.histogram_rows(labels, statistics['ratios'])
+
+            rows += ["", "Most common proportions | 最常见的比例"]
+            for fraction, count in statistics['proportions'][:self.MAX_ROWS]:
+                rows.append(f"  {fraction.numerator}:{fraction.denominator:<6} ({float(fraction):.3f})  x {count}")
+
+        rows += ["", "Angle sums at shared ends | 共享端点的角度和"]
+        for x, y, lines, angle_sum in statistics['vertices'][:self.MAX_ROWS]:
+            rows.append(f"  ({x:.0f}, {y:.0f})  {lines} lines | 条线  {angle_sum:.1f}°")
+
+        self.text.configure(state='normal')
+        self.text.delete('1.0', 'end')
+        self.text.insert('end', "\n".join(rows))
+        self.text.configure(state='disabled')
+
+
+class MeasurementServer:
+    """Local JSON-RPC server that lets other programs add, remove and query lines.
+
+    Requests are JSON-RPC 2.0 objects, one per line, sent to a Unix socket (`path`) or a
+    localhost TCP port. A JSON array of requests is applied as one batch. Methods:
+        add        {"lines": [[x1, y1, x2, y2], ...],
+                    "layer": name} (layer optional)    ->  {"lines": [line, ...]}
+        remove     {"lines": [line, ...]}              ->  {"removed": [line, ...]}
+        reference  {"line": line or null}              ->  {"reference": line or null}
+        clear      {}                                  ->  {}
+        select     {"box": [x1, y1, x2, y2]} or
+                   {"lines": [line, ...]},
+                   "add": bool (optional)              ->  {"lines": [line, ...]}
+        query      {"lines": [line, ...]} (optional)   ->  see MeasurementTool.measure_lines
+
+    Lines are identified by their canvas item id. Tk is not thread safe, so the asyncio
+    loop runs in its own thread and only parses requests; the Tk thread applies everything
+    that arrived since its last poll and refreshes the scene once for all of it.
+    """
+
+    POLL_INTERVAL = 20  # ms between checks for pending requests
+    MAX_REQUEST_SIZE = 64 * 1024 * 1024  # bytes per request line, large batches are expected
+
+    def __init__(self, tool, host='127.0.0.1', port=0, path=None):
+        self.tool = tool
+        self.host = host
+        self.port = port
+        self.path = path
+        self.address = None  # socket path or (host, port) once started
+        self.pending = queue.Queue()
+        self.changed = False  # set while a poll applies requests that edit the scene
+        self.loop = None
+        self.thread = None
+        self._started = threading.Event()
+        self._start_error = None
+        self._poll_id = None
+
+    def start(self):
+        """Start listening in a background thread and begin polling from the Tk thread."""
+        self.thread = threading.Thread(target=self._run, name="MeasurementServer", daemon=True)
+        self.thread.start()
+        self._started.wait()
+        if self._start_error:
+            raise self._start_error
+        self._poll_id = self.tool.root.after(self.POLL_INTERVAL, self.poll)
+
+    def stop(self):
+        """Stop listening and remove the Unix socket file."""
+        if self._poll_id:
+            self.tool.root.after_cancel(self._poll_id)
+            self._poll_id = None
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread:
+            self.thread.join(timeout=1)
+            self.thread = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            if self.path:
+                server = self.loop.run_until_complete(
+                    asyncio.start_unix_server(self._handle_client, path=self.path, limit=self.MAX_REQUEST_SIZE))
+                self.address = self.path
+            else:
+                server = self.loop.run_until_complete(
+                    asyncio.start_server(self._handle_client, self.host, self.port, limit=self.MAX_REQUEST_SIZE))
+                self.address = server.sockets[0].getsockname()[:2]
+        except OSError as error:
+            self._start_error = error
+            self._started.set()
+            self.loop.close()
+            return
+
+        self._started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                payload = await reader.readline()
+                if not payload:
+                    break
+                try:
+                    request = json.loads(payload)
+                except ValueError:
+                    response = self._error(None, -32700, "Parse error")
+                else:
+                    # Hand the request to the Tk thread and wait for its answer
+                    future = concurrent.futures.Future()
+                    self.pending.put((request, future))
+                    response = await asyncio.wrap_future(future)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # stop() cancels the clients still connected; ending quietly keeps asyncio from logging each one
+            pass
+        finally:
+            writer.close()
+
+    def poll(self):
+        """Apply every request received since the last poll. Runs on the Tk thread."""
+        jobs = []
+        while True:
+            try:
+                jobs.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+
+        # Whatever goes wrong, clients get their answers and the server keeps polling
+        try:
+            if jobs:
+                self.changed = False
+                responses = []
+                try:
+                    for request, future in jobs:
+                        if isinstance(request, list):
+                            responses.append((future, [self.handle_request(r) for r in request] or self._error(None, -32600, "Empty batch")))
+                        else:
+                            responses.append((future, self.handle_request(request)))
+                    # One scene update for everything that arrived since the last poll
+                    if self.changed:
+                        self.tool.refresh_scene()
+                finally:
+                    for future, response in responses:
+                        future.set_result(response)
+                    for request, future in jobs[len(responses):]:
+                        future.set_result(self._error(None, -32603, "Internal error"))
+        finally:
+            self._poll_id = self.tool.root.after(self.POLL_INTERVAL, self.poll)
+
+    def handle_request(self, request):
+        """Run a single JSON-RPC request object and return its response object."""
+        if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+            return self._error(None, -32600, "Invalid request")
+        request_id = request.get('id')
+        params = request.get('params') or {}
+        handler = getattr(self, 'rpc_' + request['method'], None)
+        if handler is None:
+            return self._error(request_id, -32601, f"Method not found: {request['method']}")
+        try:
+            result = handler(**params)
+        except (KeyError, TypeError, ValueError) as error:
+            return self._error(request_id, -32602, f"Invalid params: {error}")
+        except Exception as error:
+            return self._error(request_id, -32603, f"Internal error: {error}")
+        return {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+
+    def _error(self, request_id, code, message):
+        return {'jsonrpc': '2.0', 'id': request_id, 'error': {'code': code, 'message': message}}
+
+    def rpc_add(self, lines, layer=None):
+        layer = self.tool.layers[layer] if layer is not None else None
+        coords = [tuple(float(c) for c in line) for line in lines]
+        for x1, y1, x2, y2 in coords:
+            # json.loads accepts NaN and Infinity, which Tk can't draw
+            if not all(isfinite(c) for c in (x1, y1, x2, y2)):
+                raise ValueError(f"line {[x1, y1, x2, y2]} has a coordinate that is not a finite number")
+            if sqrt((x2 - x1)**2 + (y2 - y1)**2) < 2:
+                raise ValueError(f"line {[x1, y1, x2, y2]} is shorter than 2 pixels")
+        self.changed = True
+        return {'lines': [self.tool.commit_line(*c, layer=layer) for c in coords]}
+
+    def rpc_remove(self, lines):
+        removed = self.tool.delete_lines(lines)
+        self.changed = self.changed or bool(removed)
+        return {'removed': removed}
+
+    def rpc_reference(self, line=None):
+        if line is None:
+            self.tool.remove_reference_line()
+            self.tool.journal_reference(self.tool.active_layer)
+            return {'reference': None}
+        if line not in self.tool.line_data:
+            raise ValueError(f"unknown line {line}")
+        self.tool.set_reference_line(line)
+        self.tool.journal_reference(self.tool.line_data[line]['layer'])
+        return {'reference': line}
+
+    def rpc_clear(self):
+        self.tool.clear_screen()
+        return {}
+
+    def rpc_select(self, box=None, lines=None, add=False):
+        if box is not None:
+            lines = self.tool.lines_in_box(*(float(c) for c in box))
+        unknown = [line for line in lines or () if line not in self.tool.line_data]
+        if unknown:
+            raise ValueError(f"unknown lines {unknown}")
+        selected = set(lines or ())
+        if add:
+            selected |= self.tool.selected_lines
+        self.tool.select_lines(selected)
+        return {'lines': sorted(selected)}
+
+    def rpc_query(self, lines=None):
+        return self.tool.measure_lines(lines)
+
+
+class MeasurementClient:
+    """Small blocking client for MeasurementServer, for scripts and tests.
+
+    `address` is a Unix socket path or a (host, port) tuple.
+    """
+
+    def __init__(self, address, timeout=10):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(address)
+        else:
+            self.sock = socket.create_connection(tuple(address), timeout=timeout)
+        self.stream = self.sock.makefile('rwb')
+        self._ids = count(1)
+
+    def _send(self, payload):
+        self.stream.write(json.dumps(payload).encode() + b"\n")
+        self.stream.flush()
+        return json.loads(self.stream.readline())
+
+    def call(self, method, **params):
+        """Call one method and return its result, raising RuntimeError on an error response."""
+        response = self._send({'jsonrpc': '2.0', 'id': next(self._ids), 'method': method, 'params': params})
+        if 'error' in response:
+            raise RuntimeError(response['error']['message'])
+        return response['result']
+
+    def batch(self, calls):
+        """Send [(method, params), ...] as one JSON-RPC batch and return the list of responses."""
+        requests = [{'jsonrpc': '2.0', 'id': next(self._ids), 'method': method, 'params': params}
+                    for method, params in calls]
+        return self._send(requests)
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
 
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    tool = MeasurementTool(root)
-    root.mainloop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Measure ratios and angles on screen")
+    parser.add_argument('--serve', action='store_true', help="accept commands from other programs on localhost")
+    parser.add_argument('--port', type=int, default=8765, help="TCP port for --serve (default 8765)")
+    parser.add_argument('--socket', help="serve on this Unix socket instead of a TCP port")
+    parser.add_argument('--export', nargs='+', metavar='SCENE', help="render scenes saved as .json with 'e' to pictures, without opening the overlay")
+    parser.add_argument('--out', default='.', help="folder for --export pictures (default: current folder)")
+    parser.add_argument('--scale', type=float, action='append', help="resolution multiplier for --export, repeat for several sizes (default 1)")
+    parser.add_argument('--format', choices=['png', 'svg'], action='append', help="picture format for --export, repeat for both (default png)")
+    parser.add_argument('--workers', type=int, help="processes used by --export (default: one per CPU)")
+    parser.add_argument('--journal', default=os.path.join(os.path.expanduser('~'), '.measuretool'),
+                        help="folder where edits are journaled and restored from on start (default: ~/.measuretool)")
+    parser.add_argument('--no-journal', action='store_true', help="start empty and don't journal edits")
+    args = parser.parse_args()
+
+    if args.export:
+        jobs = []
+        for scene_path in args.export:
+            name = os.path.splitext(os.path.basename(scene_path))[0]
+            for scale in args.scale or [1.0]:
+                for picture_format in args.format or ['png']:
+                    jobs.append((scene_path, os.path.join(args.out, f"{name}@{scale:g}x.{picture_format}"), scale))
+        os.makedirs(args.out, exist_ok=True)
+        for path in export_scenes(jobs, max_workers=args.workers):
+            print(path)
+    else:
+        root = tk.Tk()
+        tool = MeasurementTool(root)
+        if not args.no_journal:
+            try:
+                tool.open_journal(args.journal)
+            except JournalLockedError as error:
+                warnings.warn(f"{error}, starting without a journal as with --no-journal", RuntimeWarning)
+        if args.serve or args.socket:
+            tool.start_server(port=args.port, path=args.socket)
+        root.mainloop()
\ No newline at end of file
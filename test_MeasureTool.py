@@ -0,0 +1,788 @@
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import types
+import unittest
+import tkinter as tk
+from fractions import Fraction
+from math import atan2, cos, hypot, radians, sin
+from unittest import mock
+
+import MeasureTool
+from MeasureTool import (MeasurementServer, MeasurementClient, StrokeSimplifier, SegmentIndex, scene_to_svg, export_scene,
+                         scene_statistics, OperationJournal, JournalLockedError, MeasurementTool)
+
+
+class StubRoot:
+    """Stands in for the Tk root: after() only queues callbacks until run_pending()."""
+
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, callback):
+        self.scheduled.append(callback)
+        return len(self.scheduled)
+
+    def after_cancel(self, after_id):
+        pass
+
+    def run_pending(self):
+        callbacks, self.scheduled = self.scheduled, []
+        for callback in callbacks:
+            callback()
+
+
+class StubTool:
+    """The parts of MeasurementTool that rpc_add touches, with a canvas that can fail like Tcl does."""
+
+    def __init__(self):
+        self.root = StubRoot()
+        self.layers = {}
+        self.lines = []
+        self.refreshed = 0
+        self.fail_after = None  # number of lines committed before commit_line raises
+
+    def commit_line(self, x1, y1, x2, y2, layer=None):
+        if len(self.lines) == self.fail_after:
+            raise tk.TclError("floating point value is Not a Number")
+        self.lines.append((x1, y1, x2, y2))
+        return len(self.lines)
+
+    def refresh_scene(self):
+        self.refreshed += 1
+
+
+class StubCanvas:
+    """Enough of tk.Canvas for MeasurementTool, keeping items as dicts so tests can look at them."""
+
+    def __init__(self, *args, **kwargs):
+        self.ids = itertools.count(1)
+        self.items = {}  # id -> {'kind', 'coords', 'options', 'tags'}
+
+    def __getattr__(self, name):
+        if not name.startswith('create_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.create(name[len('create_'):], args, kwargs)
+
+    def create(self, kind, args, kwargs):
+        item = next(self.ids)
+        coords = list(args[0]) if len(args) == 1 and isinstance(args[0], (list, tuple)) else list(args)
+        tags = kwargs.get('tags', ())
+        self.items[item] = {'kind': kind, 'coords': [float(c) for c in coords], 'options': dict(kwargs),
+                            'tags': [tags] if isinstance(tags, str) else list(tags)}
+        return item
+
+    def find(self, tag):
+        """Return the ids matching an id, a tag or the 'tag&&!(hidden||...)' expressions the tool uses."""
+        if isinstance(tag, int):
+            return [tag] if tag in self.items else []
+        if tag == 'all':
+            return list(self.items)
+        excluded = set()
+        if '&&!(' in tag:
+            tag, rest = tag.split('&&!(')
+            excluded = set(rest.rstrip(')').split('||'))
+        return [item for item, data in self.items.items() if tag in data['tags'] and not excluded & set(data['tags'])]
+
+    def delete(self, *tags):
+        for tag in tags:
+            for item in self.find(tag):
+                del self.items[item]
+
+    def coords(self, item, *coords):
+        if not coords:
+            found = self.find(item)
+            return list(self.items[found[0]]['coords']) if found else []
+        if len(coords) == 1:
+            coords = coords[0]
+        for found in self.find(item):
+            self.items[found]['coords'] = [float(c) for c in coords]
+
+    def itemconfigure(self, item, **options):
+        for found in self.find(item):
+            self.items[found]['options'].update(options)
+
+    itemconfig = itemconfigure
+
+    def itemcget(self, item, option):
+        return self.items[self.find(item)[0]]['options'].get(option, '')
+
+    def find_all(self):
+        return tuple(self.items)
+
+    def find_withtag(self, tag):
+        return tuple(self.find(tag))
+
+    def gettags(self, item):
+        return tuple(self.items[item]['tags']) if item in self.items else ()
+
+    def addtag_withtag(self, new_tag, tag):
+        for found in self.find(tag):
+            if new_tag not in self.items[found]['tags']:
+                self.items[found]['tags'].append(new_tag)
+
+    def dtag(self, item, tag):
+        for found in self.find(item):
+            if tag in self.items[found]['tags']:
+                self.items[found]['tags'].remove(tag)
+
+    def winfo_width(self):
+        return 1920
+
+    def winfo_height(self):
+        return 1080
+
+    def text(self, kind):
+        """Sorted texts of the items the tool registered in `kind` ('angle', 'ratio', 'intersection', ...)."""
+        return sorted(self.items[item]['options']['text'] for item, category in self.registry.items.items()
+                      if category == kind)
+
+    def pack(self, **kwargs):
+        pass
+
+    def bind(self, *args, **kwargs):
+        pass
+
+    def tag_raise(self, *args):
+        pass
+
+    def tag_lower(self, *args):
+        pass
+
+    def lift(self, *args):
+        pass
+
+    def lower(self, *args):
+        pass
+
+    def configure(self, **kwargs):
+        pass
+
+    def cget(self, option):
+        return 'grey'
+
+
+class StubWidget:
+    """Stands in for the root, the overlay and labels; after_idle() callbacks wait for run_idle()."""
+
+    def __init__(self, *args, **kwargs):
+        self.idle = []
+
+    def after(self, ms, callback=None, *args):
+        return 'after'
+
+    def after_idle(self, callback, *args):
+        self.idle.append(callback)
+
+    def after_cancel(self, after_id):
+        pass
+
+    def run_idle(self):
+        while self.idle:
+            self.idle.pop(0)()
+
+    def __getattr__(self, name):
+        # geometry, attributes, configure, bind, place, withdraw, destroy, ... do nothing
+        return lambda *args, **kwargs: None
+
+
+class Event:
+    def __init__(self, x, y, keysym=None):
+        self.x, self.y, self.keysym = x, y, keysym
+
+
+class ToolTestCase(unittest.TestCase):
+    """Runs a real MeasurementTool on a StubCanvas, driven through its mouse and key handlers."""
+
+    def setUp(self):
+        for name, stub in (('Toplevel', StubWidget), ('Label', StubWidget), ('Canvas', StubCanvas)):
+            patcher = mock.patch.object(MeasureTool.tk, name, stub)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.tool = self.make_tool()
+
+    def make_tool(self):
+        tool = MeasurementTool(StubWidget())
+        tool.canvas.registry = tool.canvas_items
+        return tool
+
+    def draw(self, x1, y1, x2, y2, mode='f', tool=None):
+        """Draw a line like a user: hold the mode key, press, drag and release."""
+        tool = tool or self.tool
+        tool.drawing_mode = mode
+        tool.on_click(Event(x1, y1))
+        if mode == 'f':
+            # Holding 'f' starts the line wherever the pointer is
+            tool.start_x, tool.start_y = x1, y1
+        tool.on_drag(Event((x1 + x2) / 2, (y1 + y2) / 2))
+        tool.on_drag(Event(x2, y2))
+        tool.on_release(Event(x2, y2))
+        tool.stop_drawing(None)
+        tool.root.run_idle()
+
+    def line_at(self, x1, y1, x2, y2, tool=None):
+        tool = tool or self.tool
+        return next(line for line, data in tool.lines if data['coords'] == (x1, y1, x2, y2))
+
+    def labels(self, tool):
+        return {kind: tool.canvas.text(kind) for kind in ('angle', 'ratio', 'intersection')}
+
+    def assert_scene_matches(self, tool):
+        """Check the labels and indexes of an edited scene against the same lines drawn from scratch."""
+        vertex_lines = {}
+        for line, data in tool.lines:
+            x1, y1, x2, y2 = data['coords']
+            vertex_lines.setdefault((x1, y1), set()).add(line)
+            vertex_lines.setdefault((x2, y2), set()).add(line)
+        self.assertEqual(tool.vertex_lines, vertex_lines)
+        self.assertEqual(tool.segment_index.query(-1e9, -1e9, 1e9, 1e9), set(tool.line_data))
+
+        fresh = self.make_tool()
+        reference = tool.line_data[tool.active_layer.reference_line]['coords']
+        for line, data in sorted(tool.lines, key=lambda item: item[1]['coords'] != reference):
+            fresh.commit_line(*data['coords'])
+        fresh.refresh_scene()
+        self.assertEqual(self.labels(tool), self.labels(fresh))
+        self.assertEqual(tool.check_item_budget(strict=True), {})
+
+
+class CanvasItemBudgetTest(ToolTestCase):
+    def test_drawing_undo_and_clear_leave_no_items_behind(self):
+        tool = self.tool
+        for i in range(20):
+            self.draw(100 + 30 * i, 100, 100 + 30 * i, 400)
+            # Start at the end of the last line so purple labels come and go as well
+            self.draw(100 + 30 * i, 400, 130 + 30 * i, 100, mode='d')
+        for i in range(200):
+            tool.on_mouse_move(Event(i * 5, i * 3))
+            tool.on_click(Event(i * 5, i * 3))
+            tool.on_release(Event(i * 5, i * 3))
+        self.assertEqual(tool.check_item_budget(strict=True), {})
+
+        counts = tool.canvas_items.counts()
+        self.assertLessEqual(counts['crosshair'], 2)
+        self.assertLessEqual(counts['intersection'], len(tool.lines))
+        for _ in range(10):
+            tool.undo_last_action()
+        self.assertEqual(tool.check_item_budget(strict=True), {})
+        self.assertEqual(len(tool.canvas.text('angle')), len(tool.lines))
+
+        tool.clear_screen()
+        tool.root.run_idle()
+        self.assertEqual(tool.check_item_budget(strict=True), {})
+        self.assertEqual(tool.canvas_items.counts()['line'], 0)
+
+    def test_strict_check_fails_on_a_leak(self):
+        self.draw(100, 100, 300, 100)
+        self.tool.canvas.create_line(0, 0, 10, 10)
+        with self.assertRaises(RuntimeError):
+            self.tool.check_item_budget(strict=True)
+
+
+class DeleteUndoTest(ToolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.draw(100, 100, 300, 100)
+        self.draw(100, 200, 200, 200)
+        self.draw(100, 300, 150, 300)
+        self.coords = [data['coords'] for _, data in self.tool.lines]
+        self.ratios = self.tool.canvas.text('ratio')
+
+    def delete_reference_line(self, tool):
+        tool.select_lines([self.line_at(100, 100, 300, 100, tool)])
+        tool.delete_selected_lines()
+        tool.root.run_idle()
+
+    def test_undo_brings_back_deleted_lines_before_older_edits(self):
+        tool = self.tool
+        self.delete_reference_line(tool)
+        self.assertIsNone(tool.active_layer.reference_line)
+
+        tool.undo_last_action()
+        tool.root.run_idle()
+        self.assertEqual(sorted(data['coords'] for _, data in tool.lines), sorted(self.coords))
+        self.assertEqual(tool.active_layer.reference_line, self.line_at(100, 100, 300, 100))
+        self.assertEqual(tool.canvas.text('ratio'), self.ratios)
+        self.assertEqual(tool.check_item_budget(strict=True), {})
+
+        # The next undo takes back the newest line, not the one that was deleted
+        tool.undo_last_action()
+        self.assertEqual(sorted(data['coords'] for _, data in tool.lines), sorted(self.coords[:2]))
+
+    def test_journal_replays_delete_and_its_undo(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tool = self.make_tool()
+            tool.open_journal(directory)
+            for x1, y1, x2, y2 in self.coords:
+                self.draw(x1, y1, x2, y2, tool=tool)
+            self.delete_reference_line(tool)
+            state = tool.scene_state()
+            tool.journal.sync()
+            tool.journal.lock_file.close()  # crash without closing the journal
+
+            restored = self.make_tool()
+            restored.open_journal(directory)
+            self.assertEqual(restored.scene_state(), state)
+            restored.undo_last_action()
+            self.assertEqual(sorted(data['coords'] for _, data in restored.lines), sorted(self.coords))
+            self.assertEqual(restored.active_layer.reference_line, self.line_at(100, 100, 300, 100, restored))
+            restored.journal.close()
+
+
+class GroupTransformTest(ToolTestCase):
+    def setUp(self):
+        super().setUp()
+        self.draw(100, 100, 300, 100)
+        self.draw(300, 100, 300, 200)
+        self.draw(300, 200, 500, 300)
+        self.draw(200, 50, 200, 250)
+        self.coords = sorted(data['coords'] for _, data in self.tool.lines)
+        self.tool.select_lines([self.line_at(300, 100, 300, 200), self.line_at(300, 200, 500, 300)])
+
+    def transform(self, mode, *points):
+        tool = self.tool
+        tool.drawing_mode = mode
+        tool.on_click(Event(*points[0]))
+        for point in points[1:]:
+            tool.on_drag(Event(*point))
+        tool.on_release(Event(*points[-1]))
+        tool.drawing_mode = None
+        tool.root.run_idle()
+
+    def test_labels_and_indexes_follow_a_transform_and_its_undo(self):
+        tool = self.tool
+        for mode, points in (('m', [(400, 200), (350, 180), (330, 170)]),
+                             ('r', [(500, 200), (450, 300), (400, 350)]),
+                             ('g', [(500, 200), (600, 250)])):
+            labels = self.labels(tool)
+            self.transform(mode, *points)
+            self.assertNotEqual(self.labels(tool), labels)
+            self.assert_scene_matches(tool)
+        for _ in range(3):
+            tool.undo_last_action()
+            tool.root.run_idle()
+        self.assertEqual(sorted(data['coords'] for _, data in tool.lines), self.coords)
+        self.assert_scene_matches(tool)
+
+    def test_press_and_release_without_a_drag_is_not_an_edit(self):
+        tool = self.tool
+        undo_stack = list(tool.undo_stack)
+        for mode in ('m', 'r', 'g'):
+            self.transform(mode, (400, 200))
+        self.assertEqual(tool.undo_stack, undo_stack)
+        self.assertEqual(sorted(data['coords'] for _, data in tool.lines), self.coords)
+
+
+class VertexDragTest(ToolTestCase):
+    def drag(self, *points):
+        tool = self.tool
+        tool.drawing_mode = None
+        tool.on_click(Event(*points[0]))
+        for point in points[1:]:
+            tool.on_drag(Event(*point))
+        tool.on_release(Event(*points[-1]))
+        tool.root.run_idle()
+
+    def test_labels_and_indexes_follow_a_vertex_drag_and_its_undo(self):
+        tool = self.tool
+        self.draw(100, 100, 300, 100)
+        self.draw(300, 100, 300, 200)
+        self.draw(300, 200, 500, 300)
+        self.draw(200, 50, 200, 250)
+        coords = sorted(data['coords'] for _, data in tool.lines)
+        labels = self.labels(tool)
+
+        self.drag((300, 200), (320, 220), (350, 250))
+        self.assertEqual(tool.vertex_lines[(350, 250)], {self.line_at(300, 100, 350, 250), self.line_at(350, 250, 500, 300)})
+        self.assertNotIn((300, 200), tool.vertex_lines)
+        self.assertNotEqual(self.labels(tool), labels)
+        self.assert_scene_matches(tool)
+
+        tool.undo_last_action()
+        tool.root.run_idle()
+        self.assertEqual(sorted(data['coords'] for _, data in tool.lines), coords)
+        self.assertEqual(self.labels(tool), labels)
+        self.assert_scene_matches(tool)
+
+
+@unittest.skipIf(MeasureTool.np is None, "perspective mode needs NumPy")
+class PerspectiveTest(ToolTestCase):
+    VANISHING_POINTS = [(-500, 400), (2500, 420), (960, -3000)]
+
+    def segments(self, rng, count, points=VANISHING_POINTS):
+        """Segments somewhere on screen aimed at the points in turn, each off by up to a tenth of a degree."""
+        segments = []
+        for index in range(count):
+            point_x, point_y = points[index % len(points)]
+            x, y = rng.uniform(400, 1500), rng.uniform(100, 1000)
+            angle = atan2(point_y - y, point_x - x) + radians(rng.uniform(-0.1, 0.1))
+            length = rng.uniform(80, 300)
+            segments.append((x, y, x + length * cos(angle), y + length * sin(angle)))
+        return segments
+
+    def estimate(self, tool):
+        return sorted((vanishing_point['point'], vanishing_point['lines']) for vanishing_point in tool.vanishing_points())
+
+    def test_incremental_estimate_matches_a_full_search(self):
+        tool = self.tool
+        rng = random.Random(0)
+        for segment in self.segments(rng, 12):
+            tool.commit_line(*segment)
+        tool.refresh_scene()
+        tool.toggle_perspective_mode()
+        for segment in self.segments(rng, 90):
+            tool.commit_line(*segment)
+            tool.refresh_scene()
+            tool.root.run_idle()
+        self.assertLess(tool.perspective['searched'], len(tool.lines))
+        incremental = self.estimate(tool)
+
+        tool.toggle_perspective_mode()
+        tool.toggle_perspective_mode()
+        full = self.estimate(tool)
+        self.assertEqual(len(incremental), len(self.VANISHING_POINTS))
+        self.assertEqual([lines for _, lines in incremental], [lines for _, lines in full])
+        for (point, _), (full_point, _), expected in zip(incremental, full, sorted(self.VANISHING_POINTS)):
+            self.assertLess(hypot(point[0] - full_point[0], point[1] - full_point[1]), 0.01 * hypot(*expected))
+            self.assertLess(hypot(point[0] - expected[0], point[1] - expected[1]), 0.05 * hypot(*expected))
+
+    def test_point_found_again_next_to_a_drifted_one_is_merged(self):
+        tool = self.tool
+        rng = random.Random(1)
+        left, right = self.VANISHING_POINTS[:2]
+        for segment in self.segments(rng, 60, [left, right]):
+            tool.commit_line(*segment)
+        tool.refresh_scene()
+        tool.toggle_perspective_mode()
+        # Drift the right point down by 60 pixels: under PERSPECTIVE_TOLERANCE on the Gaussian sphere, but missed by many lines
+        center_x, center_y, scale = tool.perspective_frame()
+        point = MeasureTool.np.array([(right[0] - center_x) / scale, (right[1] + 60 - center_y) / scale, 1])
+        point /= MeasureTool.np.linalg.norm(point)
+        group = max(tool.perspective['groups'], key=lambda group: abs(group['point'] @ point))
+        group['point'] = point
+        count = len(group['lines'])
+
+        for segment in self.segments(rng, 10, [left]) + self.segments(rng, 5, [right]):
+            tool.commit_line(*segment)
+        tool.refresh_scene()
+        tool.root.run_idle()
+        # The lines that missed the drifted point make up a new point right next to it, which joins it
+        self.assertEqual(tool.perspective['added'], 15)
+        self.assertEqual(len(tool.perspective['groups']), 2)
+        self.assertEqual(len(group['lines']), count + 5)
+        x, y = tool.vanishing_points()[1]['point']
+        self.assertLess(hypot(x - right[0], y - right[1]), 0.01 * hypot(*right))
+
+
+class LabelStyleTest(ToolTestCase):
+    def styles(self, tool, kind):
+        """(color, font size) of the snapshot labels and canvas items of `kind`."""
+        # Snapshot labels are told apart by text, so skip texts labels of another kind show as well
+        texts = set(tool.canvas.text(kind)).difference(*(tool.canvas.text(other) for other in tool.label_styles if other != kind))
+        snapshot = {(label['color'], label['font_size']) for label in tool.scene_snapshot()['labels'] if label['text'] in texts}
+        canvas = {(tool.canvas.items[item]['options']['fill'], tool.canvas.items[item]['options']['font'][1])
+                  for item, category in tool.canvas_items.items.items() if category == kind}
+        return snapshot, canvas
+
+    def test_settings_reach_labels_snapshot_and_new_lines(self):
+        tool = self.tool
+        self.draw(100, 100, 300, 100)
+        self.draw(350, 200, 300, 100)
+        self.assertEqual(self.styles(tool, 'angle'), ({('red', 12)}, {('red', 12)}))
+
+        settings = types.SimpleNamespace(parent=tool, font_color_var=types.SimpleNamespace(get=lambda: 'blue'))
+        version = tool.scene_version
+        MeasureTool.SettingsWindow.apply_font_size(settings, '20')
+        MeasureTool.SettingsWindow.apply_font_color(settings)
+        MeasureTool.SettingsWindow.apply_ratio_font_size(settings, '16')
+        MeasureTool.SettingsWindow.apply_intersection_font_size(settings, '9')
+        # Every change re-renders the raster
+        self.assertEqual(tool.scene_version, version + 4)
+
+        self.draw(100, 300, 200, 400)
+        self.assertEqual(self.styles(tool, 'angle'), ({('blue', 20)}, {('blue', 20)}))
+        self.assertEqual(self.styles(tool, 'ratio'), ({('black', 16)}, {('black', 16)}))
+        self.assertEqual(self.styles(tool, 'intersection'), ({('purple', 9)}, {('purple', 9)}))
+
+
+class MeasurementServerErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.tool = StubTool()
+        self.server = MeasurementServer(self.tool, port=0)
+        self.server.start()
+        self.client = MeasurementClient(self.server.address, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def send(self, calls):
+        """Send a batch from another thread while this one plays the Tk loop, and return the responses."""
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(responses=self.client.batch(calls)))
+        thread.start()
+        while thread.is_alive():
+            self.tool.root.run_pending()
+            thread.join(0.01)
+        return result['responses']
+
+    def test_add_rejects_non_finite_coordinates(self):
+        [response] = self.send([('add', {'lines': [[0, 0, float('nan'), 10]]})])
+        self.assertEqual(response['error']['code'], -32602)
+        self.assertIn('finite', response['error']['message'])
+        self.assertEqual(self.tool.lines, [])
+        self.assertEqual(self.tool.refreshed, 0)
+
+    def test_internal_error_is_answered_and_server_keeps_polling(self):
+        self.tool.fail_after = 1
+        failed, other = self.send([('add', {'lines': [[0, 0, 10, 0], [0, 0, 0, 10]]}), ('query', {})])
+        self.assertEqual(failed['error']['code'], -32603)
+        self.assertIn('Not a Number', failed['error']['message'])
+        # The line committed before the failure still gets its labels
+        self.assertEqual(self.tool.refreshed, 1)
+        # StubTool has no measure_lines, which is an internal error as well
+        self.assertEqual(other['error']['code'], -32603)
+        self.assertTrue(self.tool.root.scheduled)
+
+        self.tool.fail_after = None
+        [response] = self.send([('add', {'lines': [[0, 0, 0, 20]]})])
+        self.assertEqual(response['result'], {'lines': [2]})
+        self.assertEqual(self.tool.refreshed, 2)
+
+    def test_stop_with_clients_connected_is_quiet(self):
+        idle = socket.create_connection(self.server.address)
+        waiting = socket.create_connection(self.server.address)
+        self.addCleanup(idle.close)
+        self.addCleanup(waiting.close)
+        # Nobody polls, so this request is still waiting for the Tk thread when the server stops
+        waiting.sendall(b'{"jsonrpc": "2.0", "id": 1, "method": "query"}\n')
+        while self.server.pending.empty():
+            time.sleep(0.01)
+        with self.assertNoLogs('asyncio', level='ERROR'):
+            self.server.stop()
+        self.assertEqual(waiting.recv(1), b'')
+
+
+class StrokeSimplifierTest(unittest.TestCase):
+    def test_finish_keeps_the_filtered_tail(self):
+        stroke = StrokeSimplifier(0, 0)
+        for x in (5, 10, 11):
+            stroke.add(x, 0)
+        self.assertEqual(stroke.length(), 11)
+        self.assertEqual(stroke.finish(), [(0, 0), (11, 0)])
+        self.assertEqual(stroke.length(), 11)
+
+
+class SegmentIndexTest(unittest.TestCase):
+    def check(self, index, segments, rng):
+        """Compare box queries with a scan of every segment."""
+        for _ in range(50):
+            x, y = rng.uniform(-50, 1000), rng.uniform(-50, 1000)
+            box = (x, y, x + rng.uniform(0, 300), y + rng.uniform(0, 300))
+            expected = {key for key, (x1, y1, x2, y2) in segments.items()
+                        if min(x1, x2) <= box[2] and max(x1, x2) >= box[0] and min(y1, y2) <= box[3] and max(y1, y2) >= box[1]}
+            self.assertEqual(index.query(*box), expected)
+
+    def test_query_matches_a_scan_through_inserts_moves_and_removals(self):
+        rng = random.Random(0)
+        index = SegmentIndex()
+        segments = {}
+        segment = lambda: tuple(rng.uniform(0, 1000) for _ in range(4))
+        for key in range(1000):
+            segments[key] = segment()
+            index.insert(key, segments[key])
+        self.check(index, segments, rng)
+        self.assertEqual(index.packed, 1000)
+
+        # Few edits stay in the buffer, then enough of them force a repack
+        for count in (10, 300):
+            for key in rng.sample(sorted(segments), count):
+                if rng.random() < 0.5:
+                    index.remove(key)
+                    del segments[key]
+                else:
+                    segments[key] = segment()
+                    index.insert(key, segments[key])
+            for key in range(1000 + count, 1000 + 2 * count):
+                segments[key] = segment()
+                index.insert(key, segments[key])
+            packed = index.packed
+            self.check(index, segments, rng)
+            self.assertEqual(index.packed != packed, count == 300)
+            self.assertEqual(len(index), len(segments))
+
+        for key in list(segments):
+            index.remove(key)
+        self.assertEqual(index.query(-1e9, -1e9, 1e9, 1e9), set())
+
+
+@unittest.skipIf(MeasureTool.np is None, "the statistics panel needs NumPy")
+class SceneStatisticsTest(unittest.TestCase):
+    def test_small_scene(self):
+        nan = float('nan')
+        coords = [
+            (0, 0, 100, 0),  # the reference line
+            (0, 0, 0, 50),
+            (0, 0, 30, 40),  # 53.13° and half the reference
+            (100, 0, 100, 75),
+            (300, 300, 400, 400),  # on a layer without a reference line
+            (500, 0, 533.34, 0),  # a third of the reference, within the 1% tolerance
+        ]
+        statistics = scene_statistics(coords, [100, 100, 100, 100, nan, 100])
+        self.assertEqual(statistics['count'], 6)
+        self.assertEqual(statistics['angles'], [2, 0, 0, 0, 1, 1, 0, 0, 2])
+        self.assertEqual(statistics['ratios'], [0, 1, 2, 1, 1, 0, 0, 0, 0, 0])
+        self.assertEqual(statistics['quartiles'], [0.5, 0.5, 0.75])
+        self.assertEqual(statistics['proportions'], [(Fraction(1, 2), 2), (Fraction(1, 3), 1), (Fraction(3, 4), 1), (Fraction(1), 1)])
+        # Three lines meet at the origin and two at (100, 0); both leave a right angle between their outer lines
+        [(x, y, lines, angle_sum), (x2, y2, lines2, angle_sum2)] = statistics['vertices']
+        self.assertEqual((x, y, lines, x2, y2, lines2), (0, 0, 3, 100, 0, 2))
+        self.assertAlmostEqual(angle_sum, 90)
+        self.assertAlmostEqual(angle_sum2, 90)
+
+    def test_scene_without_reference_or_shared_ends(self):
+        statistics = scene_statistics([(0, 0, 10, 10), (20, 0, 30, 0)], [float('nan')] * 2)
+        self.assertEqual(statistics['ratios'], [0] * 10)
+        self.assertIsNone(statistics['quartiles'])
+        self.assertEqual(statistics['proportions'], [])
+        self.assertEqual(statistics['vertices'], [])
+
+
+class SceneToSvgTest(unittest.TestCase):
+    def test_multi_line_label_gets_one_tspan_per_row(self):
+        scene = {'width': 100, 'height': 100, 'font_size': 12, 'lines': [], 'strokes': [],
+                 'labels': [{'position': (50, 40), 'text': "1.23\nchord/arc 0.95", 'color': 'black'}]}
+        svg = scene_to_svg(scene)
+        self.assertIn('<tspan x="50.00" dy="-0.6em">1.23</tspan>', svg)
+        self.assertIn('<tspan x="50.00" dy="1.2em">chord/arc 0.95</tspan>', svg)
+
+    def test_labels_keep_their_own_size_and_color(self):
+        scene = {'width': 100, 'height': 100, 'font_size': 12, 'lines': [], 'strokes': [],
+                 'labels': [{'position': (50, 40), 'text': "45.0°", 'color': 'blue', 'font_size': 20},
+                            {'position': (50, 60), 'text': "1.00", 'color': 'black'}]}
+        svg = scene_to_svg(scene, scale=2)
+        self.assertIn('<text x="100.00" y="80.00" fill="blue" font-size="40">45.0°</text>', svg)
+        self.assertIn('<text x="100.00" y="120.00" fill="black">1.00</text>', svg)
+
+
+class ExportTest(ToolTestCase):
+    def export(self, extension, scale=MeasurementTool.EXPORT_SCALE):
+        """Export the scene like 'e' does and return the path."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return export_scene(self.tool.scene_snapshot(), os.path.join(directory, 'scene' + extension), scale=scale)
+
+    def test_svg_uses_label_settings(self):
+        self.draw(100, 100, 300, 200)
+        self.tool.set_label_style('angle', font_size=30, color='blue')
+        with open(self.export('.svg'), encoding='utf-8') as f:
+            svg = f.read()
+        self.assertIn('fill="blue" font-size="60">26.6°</text>', svg)
+        self.assertIn('fill="black" font-size="24">1.00</text>', svg)
+
+    @unittest.skipIf(MeasureTool.Image is None, "PNG export needs Pillow")
+    def test_png_uses_label_settings(self):
+        from PIL import ImageChops
+        self.draw(100, 100, 300, 200)
+
+        def label_height():
+            with MeasureTool.Image.open(self.export('.png', scale=1)) as image:
+                red, green, blue = image.convert('RGB').split()
+            # Only the angle label is green: the lines are black or blue and the ratio label black
+            mask = ImageChops.multiply(green.point(lambda v: 255 if v > 100 else 0), ImageChops.lighter(red, blue).point(lambda v: 255 if v < 80 else 0))
+            box = mask.getbbox()
+            return box[3] - box[1] if box else 0
+
+        self.tool.set_label_style('angle', color='green')
+        small = label_height()
+        self.tool.set_label_style('angle', font_size=30)
+        self.assertGreater(small, 0)
+        self.assertGreater(label_height(), 2 * small)
+
+
+class OperationJournalTest(ToolTestCase):
+    def test_second_journal_on_a_directory_is_refused_until_the_first_closes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = OperationJournal(directory)
+            first.load()
+            with self.assertRaises(JournalLockedError):
+                OperationJournal(directory).load()
+            first.close()
+            second = OperationJournal(directory)
+            self.assertEqual(second.load(), (None, []))
+            second.close()
+
+    def edit(self, tool):
+        """Make one edit of every journaled kind, calling sync_journal() after each like the Tk loop would."""
+        edits = [
+            lambda: self.draw(100, 100, 300, 100, tool=tool),
+            lambda: self.draw(300, 100, 300, 200, tool=tool),
+            lambda: self.draw(200, 50, 200, 250, tool=tool),
+            lambda: self.draw(400, 400, 500, 450, mode='c', tool=tool),
+            lambda: tool.toggle_reference_line(self.line_at(200, 50, 200, 250, tool)),
+            tool.new_layer,
+            lambda: self.draw(600, 100, 700, 300, tool=tool),
+            lambda: self.draw(600, 300, 700, 100, tool=tool),
+            lambda: tool.move_lines([self.line_at(600, 100, 700, 300, tool)], [(610, 100, 700, 310)]),
+            lambda: tool.record_move([self.line_at(610, 100, 700, 310, tool)], [(600, 100, 700, 300)]),
+            lambda: tool.set_line_width(3),
+            lambda: tool.delete_lines([self.line_at(100, 100, 300, 100, tool)]),
+            lambda: self.draw(100, 500, 300, 500, tool=tool),
+            tool.undo_last_action,
+        ]
+        for edit in edits:
+            edit()
+            tool.root.run_idle()
+            tool.sync_journal()
+
+    def crash_and_reopen(self, tool, directory):
+        tool.journal.sync()
+        tool.journal.lock_file.close()  # crash without closing the journal
+        restored = self.make_tool()
+        restored.open_journal(directory)
+        self.addCleanup(restored.journal.close)
+        return restored
+
+    def test_scene_comes_back_after_a_crash(self):
+        for compact_every in (OperationJournal.COMPACT_EVERY, 4):
+            with self.subTest(compact_every=compact_every), tempfile.TemporaryDirectory() as directory, \
+                    mock.patch.object(OperationJournal, 'COMPACT_EVERY', compact_every):
+                tool = self.make_tool()
+                tool.open_journal(directory)
+                self.edit(tool)
+                restored = self.crash_and_reopen(tool, directory)
+                self.assertEqual(restored.scene_state(), tool.scene_state())
+                self.assertEqual(self.labels(restored), self.labels(tool))
+                # The delete is still on both undo stacks
+                for each in (tool, restored):
+                    each.undo_last_action()
+                    each.root.run_idle()
+                self.assertEqual(len(restored.lines), 5)
+                self.assertEqual(restored.scene_state(), tool.scene_state())
+
+    def test_journal_that_cant_be_restored_is_moved_aside(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'journal.jsonl'), 'w') as f:
+                f.write(json.dumps({'op': 'line', 'seq': 1, 'uid': 1, 'coords': [0, 0, 10, 0], 'layer': 'Layer 1'}) + "\n")
+                f.write(json.dumps({'op': 'line', 'seq': 2, 'uid': 2, 'coords': [0, 0, 0, 10], 'layer': 'Missing'}) + "\n")
+            tool = self.make_tool()
+            with self.assertWarns(RuntimeWarning):
+                tool.open_journal(directory)
+            self.assertEqual(tool.lines, [])
+            [aside] = [name for name in os.listdir(directory) if name.startswith('broken-')]
+            self.assertEqual(os.listdir(os.path.join(directory, aside)), ['journal.jsonl'])
+
+            # The fresh journal works as usual
+            self.draw(0, 0, 100, 0, tool=tool)
+            restored = self.crash_and_reopen(tool, directory)
+            self.assertEqual(restored.scene_state(), tool.scene_state())
+
+
+if __name__ == '__main__':
+    unittest.main()